@@ -0,0 +1,705 @@
+#! /usr/bin/python3
+#
+# @(!--#) @(#) rotftp-bench.py, version 001, 16-october-2026
+#
+# a load generator and benchmark for the rotftp TFTP server
+#
+# starts rotftp.py on a high local port serving a directory of generated
+# files and then runs many simulated PXE clients against it at once - each
+# client fetches every file in the file mix in turn like a machine booting
+#
+# reports aggregate throughput, transfer and boot completion time
+# percentiles and the server's CPU time per megabyte sent
+#
+# an impairment proxy can be put between the clients and the server to
+# add packet loss, duplication, delay, jitter and reordering - and a
+# sweep of loss rates shows how completion times degrade with loss
+#
+# runs entirely on the local machine - no network needed
+#
+
+##############################################################################
+
+#
+# imports
+#
+
+import os
+import sys
+import argparse
+import socket
+import subprocess
+import tempfile
+import threading
+import shlex
+import signal
+import time
+import json
+import random
+import selectors
+import heapq
+
+##############################################################################
+
+#
+# constants
+#
+
+MAX_PACKET_SIZE = 65536
+
+SERVER_START_TIMEOUT = 10.0       # seconds to wait for the server to answer requests
+CLIENT_TIMEOUT = 1.0              # seconds before a client resends its last packet
+CLIENT_RETRIES = 5                # resends before a client gives up on a transfer
+
+REORDER_HOLD = 0.002              # extra seconds a reordered packet is held back
+PROXY_CLIENT_IDLE = 30.0          # seconds before the proxy forgets a quiet client
+
+##############################################################################
+
+#
+# globals
+#
+
+DEFAULT_PORT = 16969
+DEFAULT_PROXY_PORT = 16970
+DEFAULT_CLIENTS = 10
+DEFAULT_FILEMIX = "pxelinux.0:40K,pxelinux.cfg:1K,vmlinuz:8M,initrd.img:24M"
+DEFAULT_BLOCKSIZE = 1468
+DEFAULT_WINDOWSIZE = 1
+
+##############################################################################
+
+def parsesize(sizestring):
+    multipliers = { "K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024 }
+
+    sizestring = sizestring.strip().upper()
+
+    if (len(sizestring) > 0) and (sizestring[-1] in multipliers):
+        return int(sizestring[:-1]) * multipliers[sizestring[-1]]
+
+    return int(sizestring)
+
+##############################################################################
+
+def parsefilemix(filemix):
+    files = []
+
+    for item in filemix.split(','):
+        pair = item.split(':')
+
+        if len(pair) != 2:
+            raise ValueError("file mix entry \"{}\" is not of the form name:size".format(item))
+
+        files.append((pair[0].strip(), parsesize(pair[1])))
+
+    return files
+
+##############################################################################
+
+def createfiles(directory, files):
+    for filename, filesize in files:
+        with open(os.path.join(directory, filename), "wb") as f:
+            remaining = filesize
+            while remaining > 0:
+                chunk = min(remaining, 1024 * 1024)
+                f.write(os.urandom(chunk))
+                remaining -= chunk
+
+##############################################################################
+
+def percentile(values, percent):
+    # nearest rank percentile of an already sorted list
+    if len(values) == 0:
+        return 0.0
+
+    rank = max(int(((percent / 100.0) * len(values)) + 0.999999) - 1, 0)
+
+    return values[min(rank, len(values) - 1)]
+
+##############################################################################
+
+def buildreadrequest(filename, options):
+    packet = bytearray(b'\x00\x01')
+
+    packet += filename.encode("utf-8") + b'\x00' + b'octet' + b'\x00'
+
+    for optionname, optionvalue in options:
+        packet += optionname.encode("utf-8") + b'\x00' + str(optionvalue).encode("utf-8") + b'\x00'
+
+    return bytes(packet)
+
+##############################################################################
+
+#
+# fetch one file the way a PXE client would - returns the number of bytes
+# received, the time taken and an error message ("" for success)
+#
+
+def fetchfile(serveraddress, filename, blocksize, windowsize, tsize):
+    options = []
+
+    if blocksize != 512:
+        options.append(("blksize", blocksize))
+    if windowsize != 1:
+        options.append(("windowsize", windowsize))
+    if tsize:
+        options.append(("tsize", 0))
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.settimeout(CLIENT_TIMEOUT)
+
+    starttime = time.monotonic()
+
+    lastpacket = buildreadrequest(filename, options)
+    lastaddress = serveraddress
+    transferaddress = None
+
+    # until the server answers the block size is the RFC 1350 default
+    blocksize = 512
+    windowsize = 1
+
+    expected = 1
+    inwindow = 0
+    gapacked = False
+    received = 0
+    retries = 0
+
+    try:
+        sock.sendto(lastpacket, lastaddress)
+
+        while True:
+            try:
+                packet, address = sock.recvfrom(MAX_PACKET_SIZE)
+            except socket.timeout:
+                retries += 1
+                if retries > CLIENT_RETRIES:
+                    return received, time.monotonic() - starttime, "timed out"
+                sock.sendto(lastpacket, lastaddress)
+                inwindow = 0
+                continue
+
+            if transferaddress is None:
+                transferaddress = address
+            elif address != transferaddress:
+                continue
+
+            if len(packet) < 4:
+                continue
+
+            opcode = (packet[0] * 256) + packet[1]
+
+            if opcode == 5:
+                return received, time.monotonic() - starttime, packet[4:].split(b'\x00')[0].decode("utf-8", "replace")
+
+            if opcode == 6:
+                fields = packet[2:].split(b'\x00')
+                for i in range(0, len(fields) - 1, 2):
+                    if fields[i] == b'blksize':
+                        blocksize = int(fields[i + 1])
+                    elif fields[i] == b'windowsize':
+                        windowsize = int(fields[i + 1])
+                lastpacket = b'\x00\x04\x00\x00'
+                lastaddress = transferaddress
+                sock.sendto(lastpacket, lastaddress)
+                retries = 0
+                continue
+
+            if opcode != 3:
+                continue
+
+            block = (packet[2] * 256) + packet[3]
+
+            if block != (expected % 65536):
+                if (windowsize == 1) and (block == ((expected - 1) % 65536)):
+                    # the previous block again - our ACK was probably lost so send it
+                    # again as RFC 1350/1123 receivers do (the server ignores duplicates)
+                    sock.sendto(lastpacket, lastaddress)
+                    continue
+                # out of order or a duplicate - ACK what we have (once) so the server restarts from there
+                if (windowsize > 1) and (not gapacked):
+                    sock.sendto(lastpacket, lastaddress)
+                    inwindow = 0
+                    gapacked = True
+                continue
+
+            datalength = len(packet) - 4
+            received += datalength
+            expected += 1
+            inwindow += 1
+            retries = 0
+            gapacked = False
+
+            lastpacket = b'\x00\x04' + bytes(packet[2:4])
+            lastaddress = transferaddress
+
+            if datalength < blocksize:
+                sock.sendto(lastpacket, lastaddress)
+                return received, time.monotonic() - starttime, ""
+
+            if inwindow >= windowsize:
+                sock.sendto(lastpacket, lastaddress)
+                inwindow = 0
+    finally:
+        sock.close()
+
+##############################################################################
+
+#
+# one simulated machine booting - fetch every file in the mix in order
+#
+
+def runclient(serveraddress, files, args, results, lock):
+    boottime = 0.0
+    bootfailed = False
+
+    for filename, filesize in files:
+        received, elapsed, errmsg = fetchfile(serveraddress, filename, args.blksize, args.windowsize, args.tsize)
+
+        if (errmsg == "") and (received != filesize):
+            errmsg = "received {} bytes instead of {}".format(received, filesize)
+
+        boottime += elapsed
+
+        with lock:
+            results["transfers"].append((filename, received, elapsed, errmsg))
+
+        if errmsg != "":
+            bootfailed = True
+            break
+
+    with lock:
+        if bootfailed:
+            results["bootfailures"] += 1
+        else:
+            results["boottimes"].append(boottime)
+
+##############################################################################
+
+#
+# an ImpairmentProxy sits between the test clients and the server and
+# drops, duplicates, delays and reorders packets in both directions
+#
+# TFTP changes ports part way through a transfer - the server answers a
+# request from a new port (its transfer ID) - so the proxy does the same:
+# each client gets its own upstream socket to the server and for every
+# server port that talks to the client the proxy opens a matching
+# downstream socket for the client to talk to
+#
+# all the random decisions come from one seeded generator so a run can
+# be repeated exactly
+#
+
+class ImpairmentProxy:
+    def __init__(self, listenport, serveraddress, loss, duplicate, delay, jitter, reorder, seed):
+        self.serveraddress = serveraddress
+        self.loss = loss
+        self.duplicate = duplicate
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder = reorder
+        self.random = random.Random(seed)
+
+        self.selector = selectors.DefaultSelector()
+        self.clients = {}
+        self.pending = []
+        self.sequence = 0
+        self.stopping = False
+
+        self.forwarded = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.reordered = 0
+
+        self.listensock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listensock.bind(("127.0.0.1", listenport))
+        self.listensock.setblocking(False)
+        self.selector.register(self.listensock, selectors.EVENT_READ, ("listen", None, None))
+
+        self.thread = threading.Thread(target=self.run, name="proxy", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        self.thread.join()
+
+        for client in self.clients.values():
+            client["upstream"].close()
+            for sock in client["downstream"].values():
+                sock.close()
+
+        self.listensock.close()
+        self.selector.close()
+
+    def newsocket(self, data):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        sock.bind(("127.0.0.1", 0))
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, data)
+        return sock
+
+    def getclient(self, clientaddress):
+        client = self.clients.get(clientaddress)
+
+        if client is None:
+            client = { "upstream": self.newsocket(("upstream", clientaddress, None)), "downstream": {}, "lastseen": 0.0 }
+            self.clients[clientaddress] = client
+
+        client["lastseen"] = time.monotonic()
+
+        return client
+
+    def schedule(self, sock, packet, address):
+        # decide what happens to one packet on its way through
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return
+
+        copies = 1
+        if self.random.random() < self.duplicate:
+            self.duplicated += 1
+            copies = 2
+
+        for i in range(copies):
+            delay = max(self.delay + self.random.uniform(-self.jitter, self.jitter), 0.0)
+
+            # a reordered packet is held back long enough for the next ones to overtake it
+            if self.random.random() < self.reorder:
+                self.reordered += 1
+                delay += self.delay + self.jitter + REORDER_HOLD
+
+            self.sequence += 1
+            heapq.heappush(self.pending, (time.monotonic() + delay, self.sequence, sock, packet, address))
+
+    def route(self, kind, clientaddress, serverport, packet, address):
+        if kind == "listen":
+            # a new request from a client - pass it to the server's well known port
+            client = self.getclient(address)
+            self.schedule(client["upstream"], packet, self.serveraddress)
+        elif kind == "upstream":
+            # from the server to the client - send it from the proxy port that matches the server's port
+            client = self.getclient(clientaddress)
+            if address == self.serveraddress:
+                downstream = self.listensock
+            else:
+                downstream = client["downstream"].get(address[1])
+                if downstream is None:
+                    downstream = self.newsocket(("downstream", clientaddress, address[1]))
+                    client["downstream"][address[1]] = downstream
+            self.schedule(downstream, packet, clientaddress)
+        else:
+            # from the client to the server port that this downstream socket stands in for
+            client = self.getclient(clientaddress)
+            self.schedule(client["upstream"], packet, (self.serveraddress[0], serverport))
+
+    def deliver(self):
+        now = time.monotonic()
+
+        while (len(self.pending) > 0) and (self.pending[0][0] <= now):
+            duetime, sequence, sock, packet, address = heapq.heappop(self.pending)
+            try:
+                sock.sendto(packet, address)
+                self.forwarded += 1
+            except OSError:
+                self.dropped += 1
+
+    def expireclients(self):
+        now = time.monotonic()
+
+        for clientaddress in list(self.clients):
+            client = self.clients[clientaddress]
+            if (now - client["lastseen"]) > PROXY_CLIENT_IDLE:
+                for sock in [client["upstream"]] + list(client["downstream"].values()):
+                    self.selector.unregister(sock)
+                    sock.close()
+                del self.clients[clientaddress]
+
+    def run(self):
+        lastexpiry = time.monotonic()
+
+        while not self.stopping:
+            timeout = 0.1
+            if len(self.pending) > 0:
+                timeout = min(max(self.pending[0][0] - time.monotonic(), 0.0), timeout)
+
+            for key, mask in self.selector.select(timeout):
+                kind, clientaddress, serverport = key.data
+                try:
+                    packet, address = key.fileobj.recvfrom(MAX_PACKET_SIZE)
+                except OSError:
+                    continue
+                self.route(kind, clientaddress, serverport, packet, address)
+
+            self.deliver()
+
+            if (time.monotonic() - lastexpiry) > 1.0:
+                self.expireclients()
+                lastexpiry = time.monotonic()
+
+##############################################################################
+
+def waitforserver(serveraddress, serverprocess):
+    # a request for a file that does not exist gets an error back once the server is up
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.1)
+
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+
+    try:
+        while time.monotonic() < deadline:
+            if serverprocess.poll() is not None:
+                return False
+
+            sock.sendto(buildreadrequest("rotftp-bench-probe", []), serveraddress)
+
+            try:
+                sock.recvfrom(MAX_PACKET_SIZE)
+                return True
+            except (socket.timeout, ConnectionError):
+                time.sleep(0.1)
+    finally:
+        sock.close()
+
+    return False
+
+##############################################################################
+
+def startserver(directory, args):
+    serverscript = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rotftp.py")
+
+    command = [sys.executable, serverscript, "--dir", directory, "--port", str(args.port), "--log-level", "WARNING"]
+    command += shlex.split(args.server_args)
+
+    return subprocess.Popen(command)
+
+##############################################################################
+
+def stopserver(serverprocess):
+    # returns the CPU seconds used by the server (and any workers it waited for)
+    serverprocess.send_signal(signal.SIGTERM)
+
+    pid, status, rusage = os.wait4(serverprocess.pid, 0)
+
+    serverprocess.returncode = status
+
+    return rusage.ru_utime + rusage.ru_stime
+
+##############################################################################
+
+def runbenchmark(serveraddress, files, args):
+    results = { "transfers": [], "boottimes": [], "bootfailures": 0 }
+    lock = threading.Lock()
+
+    threads = []
+    for i in range(args.clients):
+        threads.append(threading.Thread(target=runclient, args=(serveraddress, files, args, results, lock), daemon=True))
+
+    starttime = time.monotonic()
+
+    for thread in threads:
+        thread.start()
+        if args.ramp > 0:
+            time.sleep(args.ramp / args.clients)
+
+    for thread in threads:
+        thread.join()
+
+    results["walltime"] = time.monotonic() - starttime
+
+    return results
+
+##############################################################################
+
+def summarise(results, servercpu, proxy):
+    transfertimes = sorted([t[2] for t in results["transfers"] if t[3] == ""])
+    boottimes = sorted(results["boottimes"])
+    totalbytes = sum([t[1] for t in results["transfers"]])
+    failures = [t for t in results["transfers"] if t[3] != ""]
+    megabytes = totalbytes / (1024 * 1024)
+
+    summary = {
+        "clients": len(results["boottimes"]) + results["bootfailures"],
+        "boot_failures": results["bootfailures"],
+        "transfers": len(results["transfers"]),
+        "transfer_failures": len(failures),
+        "bytes": totalbytes,
+        "wall_seconds": results["walltime"],
+        "throughput_mb_per_second": megabytes / max(results["walltime"], 0.000001),
+        "transfer_seconds_p50": percentile(transfertimes, 50),
+        "transfer_seconds_p90": percentile(transfertimes, 90),
+        "transfer_seconds_p99": percentile(transfertimes, 99),
+        "transfer_seconds_max": percentile(transfertimes, 100),
+        "boot_seconds_p50": percentile(boottimes, 50),
+        "boot_seconds_p90": percentile(boottimes, 90),
+        "boot_seconds_p99": percentile(boottimes, 99),
+        "boot_seconds_max": percentile(boottimes, 100),
+        "server_cpu_seconds": servercpu,
+        "server_cpu_ms_per_mb": (servercpu * 1000) / max(megabytes, 0.000001),
+    }
+
+    errors = {}
+    for t in failures:
+        errors[t[3]] = errors.get(t[3], 0) + 1
+    summary["errors"] = errors
+
+    if proxy is not None:
+        summary["proxy_forwarded"] = proxy.forwarded
+        summary["proxy_dropped"] = proxy.dropped
+        summary["proxy_duplicated"] = proxy.duplicated
+        summary["proxy_reordered"] = proxy.reordered
+
+    return summary
+
+##############################################################################
+
+def showsummary(summary):
+    print("Clients:           {}   ({} failed to boot)".format(summary["clients"], summary["boot_failures"]))
+    print("Transfers:         {}   ({} failed)".format(summary["transfers"], summary["transfer_failures"]))
+    print("Bytes received:    {}".format(summary["bytes"]))
+    print("Wall time:         {:.3f} seconds".format(summary["wall_seconds"]))
+    print("Throughput:        {:.2f} MB/s".format(summary["throughput_mb_per_second"]))
+    print("Transfer time:     p50 {:.3f}   p90 {:.3f}   p99 {:.3f}   max {:.3f} seconds".format(
+          summary["transfer_seconds_p50"], summary["transfer_seconds_p90"], summary["transfer_seconds_p99"], summary["transfer_seconds_max"]))
+    print("Boot time:         p50 {:.3f}   p90 {:.3f}   p99 {:.3f}   max {:.3f} seconds".format(
+          summary["boot_seconds_p50"], summary["boot_seconds_p90"], summary["boot_seconds_p99"], summary["boot_seconds_max"]))
+    print("Server CPU:        {:.3f} seconds   ({:.2f} ms per MB)".format(summary["server_cpu_seconds"], summary["server_cpu_ms_per_mb"]))
+
+    if "proxy_forwarded" in summary:
+        print("Proxy:             {} forwarded   {} dropped   {} duplicated   {} reordered".format(
+              summary["proxy_forwarded"], summary["proxy_dropped"], summary["proxy_duplicated"], summary["proxy_reordered"]))
+
+    for errmsg, count in sorted(summary["errors"].items()):
+        print("Error:             {} x {}".format(count, errmsg))
+
+##############################################################################
+
+#
+# Main code
+#
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark rotftp.py with simulated PXE boot storms")
+
+    parser.add_argument("--clients", help="number of simulated clients booting at once", type=int, default=DEFAULT_CLIENTS)
+    parser.add_argument("--files", help="file mix as name:size pairs, sizes may end in K, M or G", default=DEFAULT_FILEMIX)
+    parser.add_argument("--blksize", help="block size the clients ask for", type=int, default=DEFAULT_BLOCKSIZE)
+    parser.add_argument("--windowsize", help="window size the clients ask for", type=int, default=DEFAULT_WINDOWSIZE)
+    parser.add_argument("--tsize", help="clients ask for the transfer size", action="store_true")
+    parser.add_argument("--ramp", help="seconds over which the clients are started", type=float, default=0.0)
+    parser.add_argument("--port", help="local port to run the server on", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--server-args", help="extra command line arguments for rotftp.py", default="")
+    parser.add_argument("--json", help="print the results as JSON", action="store_true")
+    parser.add_argument("--loss", help="fraction of packets the impairment proxy drops", type=float, default=0.0)
+    parser.add_argument("--loss-sweep", help="comma separated loss rates to run the benchmark at in turn", default=None)
+    parser.add_argument("--duplicate", help="fraction of packets the impairment proxy sends twice", type=float, default=0.0)
+    parser.add_argument("--delay", help="milliseconds the impairment proxy delays each packet", type=float, default=0.0)
+    parser.add_argument("--jitter", help="random milliseconds added to or taken from the delay", type=float, default=0.0)
+    parser.add_argument("--reorder", help="fraction of packets the impairment proxy holds back so later ones overtake them", type=float, default=0.0)
+    parser.add_argument("--seed", help="seed for the impairment proxy's random choices", type=int, default=1)
+    parser.add_argument("--proxy-port", help="local port for the impairment proxy", type=int, default=DEFAULT_PROXY_PORT)
+
+    args = parser.parse_args()
+
+    try:
+        files = parsefilemix(args.files)
+    except ValueError as e:
+        print("{}: {}".format(progname, e), file=sys.stderr)
+        return 2
+
+    if args.loss_sweep is not None:
+        try:
+            lossrates = [float(rate) for rate in args.loss_sweep.split(',')]
+        except ValueError:
+            print("{}: loss sweep \"{}\" is not a list of numbers".format(progname, args.loss_sweep), file=sys.stderr)
+            return 2
+    else:
+        lossrates = [args.loss]
+
+    impaired = (args.loss_sweep is not None) or (args.loss > 0) or (args.duplicate > 0) or (args.delay > 0) or (args.jitter > 0) or (args.reorder > 0)
+
+    summaries = []
+
+    with tempfile.TemporaryDirectory(prefix="rotftp-bench-") as directory:
+        createfiles(directory, files)
+
+        for lossrate in lossrates:
+            summary = runstep(directory, files, args, impaired, lossrate)
+
+            if summary is None:
+                return 1
+
+            summary["loss"] = lossrate
+            summaries.append(summary)
+
+            if (not args.json) and (len(lossrates) > 1):
+                print("Loss rate {:.3f}:".format(lossrate))
+                showsummary(summary)
+                print()
+
+    if args.json:
+        if len(summaries) == 1:
+            print(json.dumps(summaries[0], indent=2, sort_keys=True))
+        else:
+            print(json.dumps(summaries, indent=2, sort_keys=True))
+    elif len(summaries) == 1:
+        showsummary(summaries[0])
+    else:
+        print("    Loss   Transfer p50   Transfer p99      Boot p99   Failures")
+        for summary in summaries:
+            print("{:8.3f}   {:12.3f}   {:12.3f}   {:11.3f}   {:8d}".format(summary["loss"], summary["transfer_seconds_p50"],
+                  summary["transfer_seconds_p99"], summary["boot_seconds_p99"], summary["transfer_failures"]))
+
+    for summary in summaries:
+        if (summary["boot_failures"] > 0) or (summary["transfer_failures"] > 0):
+            return 1
+
+    return 0
+
+##############################################################################
+
+#
+# one benchmark run with a fresh server (and proxy if impairments are wanted)
+#
+
+def runstep(directory, files, args, impaired, lossrate):
+    serveraddress = ("127.0.0.1", args.port)
+
+    serverprocess = startserver(directory, args)
+
+    if not waitforserver(serveraddress, serverprocess):
+        print("{}: server did not start on port {}".format(progname, args.port), file=sys.stderr)
+        if serverprocess.poll() is None:
+            stopserver(serverprocess)
+        return None
+
+    proxy = None
+
+    try:
+        if impaired:
+            try:
+                proxy = ImpairmentProxy(args.proxy_port, serveraddress, lossrate, args.duplicate, args.delay / 1000.0,
+                                        args.jitter / 1000.0, args.reorder, args.seed)
+            except OSError as e:
+                print("{}: unable to start the impairment proxy on port {}: {}".format(progname, args.proxy_port, e.strerror), file=sys.stderr)
+                return None
+            proxy.start()
+            results = runbenchmark(("127.0.0.1", args.proxy_port), files, args)
+        else:
+            results = runbenchmark(serveraddress, files, args)
+    finally:
+        if proxy is not None:
+            proxy.stop()
+        servercpu = stopserver(serverprocess)
+
+    return summarise(results, servercpu, proxy)
+
+##########################################################################
+
+progname = os.path.basename(sys.argv[0])
+
+sys.exit(main())
+
+# end of file
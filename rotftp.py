@@ -4,10 +4,17 @@
 #
 # a TFTP server that does read only transfers in binary (mode "octet")
 #
-# the server assumes a super reliable connection
+# run it from the command line or import it and run a TFTPServer inside
+# an asyncio event loop
+#
+# many transfers can run at once - each one gets its own session and its
+# own ephemeral port socket and they are all driven from one selector loop
+#
+# lost packets are retransmitted with a timeout that adapts to the
+# measured round trip time of each transfer
 # does basic option negotiation
 #
-# use Ctrl+Break instead of Ctrl^C to interrupt.
+# use Ctrl+C (or SIGTERM) to stop - active transfers are allowed to finish
 #
 
 ##############################################################################
@@ -47,6 +54,41 @@ import os
 import sys
 import argparse
 import socket
+import selectors
+import time
+import heapq
+import collections
+import mmap
+import signal
+import errno
+import stat
+import ctypes
+import logging
+import logging.handlers
+import queue
+import bisect
+import threading
+import http.server
+import struct
+import glob
+import gzip
+import lzma
+import zlib
+import shutil
+import hashlib
+import tempfile
+import ipaddress
+import tarfile
+import zipfile
+import fnmatch
+import asyncio
+import cProfile
+import pstats
+
+try:
+    import zstandard              # optional - only needed to serve .zst files
+except ImportError:
+    zstandard = None
 
 ##############################################################################
 
@@ -56,6 +98,72 @@ import socket
 
 MAX_PACKET_SIZE = 65536
 
+MIN_BLOCKSIZE = 8                 # RFC 2348 block size range
+MAX_BLOCKSIZE = 65464
+IP_UDP_TFTP_HEADERS = 32          # IPv4 (20) + UDP (8) + TFTP DATA (4) header bytes
+LINUX_IP_MTU = 14                 # socket.IP_MTU is missing from some Python builds
+LINUX_MAP_NORESERVE = 0x4000      # and mmap.MAP_NORESERVE from all of them
+
+DEFAULT_WINDOWSIZE = 1            # RFC 1350 lock step - one block per ACK
+MAX_WINDOWSIZE = 64               # largest window (RFC 7440) we will agree to
+
+SELECT_INTERVAL = 1.0             # longest wait in the selector when no timer is due
+
+DEFAULT_TIMEOUT = 1.0             # initial retransmit timeout when the client does not ask for one
+MIN_TIMEOUT = 0.05                # adaptive retransmit timeout never goes below this
+MAX_TIMEOUT = 16.0                # or above this, even after backing off
+MAX_RETRIES = 5                   # retransmissions without an ACK before giving up
+
+CACHE_CHUNK_SIZE = 65536          # files are cached in chunks of this many bytes
+STREAM_CACHE_FRACTION = 4         # files bigger than this fraction of the cache are streamed instead
+
+MAX_OPEN_FILES = 256              # files kept open between requests
+OPEN_FILE_IDLE_TIMEOUT = 30       # seconds an unused file is kept open
+HANDLE_POLL_INTERVAL = 2.0        # seconds between stat() checks of an open file without inotify
+HANDLE_INOTIFY_RECHECK = 30.0     # and with inotify (which misses changes made by other NFS clients)
+EXPIRY_INTERVAL = 5.0             # seconds between sweeps for idle open files
+READAHEAD_BYTES = 1024 * 1024     # bytes the kernel is asked to read ahead of a transfer
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024    # bytes decompressed at a time into the spool
+
+INOTIFY_MODIFY = 0x00000002       # inotify event masks from <sys/inotify.h>
+INOTIFY_ATTRIB = 0x00000004
+INOTIFY_CLOSE_WRITE = 0x00000008
+INOTIFY_MOVE_SELF = 0x00000800
+INOTIFY_DELETE_SELF = 0x00000400
+
+SCHEDULER_QUANTUM = 65536         # bytes each waiting transfer may send per round of the scheduler
+BUCKET_BURST_SECONDS = 0.05       # token buckets hold this many seconds worth of bytes
+BUCKET_IDLE_TIMEOUT = 60          # seconds before the bucket of a client with nothing to send is dropped
+
+MULTICAST_GROUPS = 256            # multicast addresses handed out from --multicast-address upwards
+MAX_MULTICAST_BLOCKS = 65535      # RFC 2090 has no block number rollover
+
+PENDING_TIMEOUT = 5.0             # seconds a queued request waits before it is forgotten
+
+SHUTDOWN_DRAIN_TIMEOUT = 30       # seconds active transfers get to finish after a shutdown request
+WORKER_RESTART_DELAY = 1.0        # seconds before a worker process that died is restarted
+
+TOP_FILES = 10                    # most requested files reported in the metrics
+MAX_TRACKED_FILES = 1000          # distinct file names counted before the least requested are dropped
+METRICS_FILE_INTERVAL = 10        # seconds between rewrites of the metrics file
+
+PROFILE_BUCKETS = 40              # power of two nanosecond histogram buckets per profiled stage (up to 2**39 ns - about 9 minutes)
+PROFILE_TOP_FUNCTIONS = 40        # functions listed from --profile-python
+
+PROFILE_STAGES = [                # stage name, TransferEngine method timed for it
+    ("wait",      None),          # the selector wait (the select() method of the engine's selector)
+    ("receive",   "receive"),
+    ("request",   "handlelistenpacket"),
+    ("ack",       "handlesessionpacket"),
+    ("multicast", "handlemulticastpacket"),
+    ("read",      "getdatabuffers"),
+    ("send",      "sendto"),
+    ("timers",    "runtimers"),
+    ("schedule",  "runscheduler"),
+]
+
+LOG_FORMAT = "%(asctime)s rotftp[%(process)d] %(levelname)s: %(message)s"
+
 ##############################################################################
 
 #
@@ -63,38 +171,89 @@ MAX_PACKET_SIZE = 65536
 #
 
 DEFAULT_DIRECTORY = "C:\\tftpboot"
+DEFAULT_PORT = 69
 DEFAULT_BLOCKSIZE = 512
+DEFAULT_CACHE_MB = 64
+DEFAULT_MAX_PENDING = 100
+DEFAULT_MULTICAST_PORT = 1758     # tftp-mcast
+DEFAULT_SPOOL_DIRECTORY = os.path.join(tempfile.gettempdir(), "rotftp-spool")
+
+if os.path.isdir("/dev/shm"):     # the shared cache belongs on a memory file system
+    DEFAULT_SHARED_CACHE_DIRECTORY = "/dev/shm/rotftp-cache"
+else:
+    DEFAULT_SHARED_CACHE_DIRECTORY = os.path.join(tempfile.gettempdir(), "rotftp-cache")
+
+dataheader = bytearray(4)         # reused for the header of every DATA packet
+
+logger = logging.getLogger("rotftp")
+
+inotifyevent = struct.Struct("=iIII")    # wd, mask, cookie, len - then len bytes of name
+
+packetheader = struct.Struct("!HH")      # opcode then block number (ACK, DATA) or error code (ERROR)
 
 ##############################################################################
 
 def showpacket(bytes):
+    # the dump is logged as one message so it goes through the log queue
+    # with everything else and rows from different packets never interleave
     bpr = 10              # bpr is Bytes Per Row
     numbytes = len(bytes)
 
     if numbytes == 0:
-        print("<empty packet>")
-    else:
-        i = 0
-        while i < numbytes:
-            if (i % bpr) == 0:
-                print("{:04d} :".format(i), sep='', end='')
-            
-            c = bytes[i]
-            
-            if (c < 32) or (c > 126):
-                c = '?'
-            else:
-                c = chr(c)
+        logger.debug("<empty packet>")
+        return
 
-            print(" {:02X} {} ".format(bytes[i], c), sep='', end='')
+    rows = []
+    row = ""
+    i = 0
+    while i < numbytes:
+        if (i % bpr) == 0:
+            row = "{:04d} :".format(i)
+
+        c = bytes[i]
+
+        if (c < 32) or (c > 126):
+            c = '?'
+        else:
+            c = chr(c)
 
-            if ((i + 1) % bpr) == 0:
-                print()
+        row += " {:02X} {} ".format(bytes[i], c)
 
-            i = i + 1
+        if ((i + 1) % bpr) == 0:
+            rows.append(row)
+
+        i = i + 1
 
     if (numbytes % bpr) != 0:
-        print()
+        rows.append(row)
+
+    logger.debug("packet of %d bytes:\n%s", numbytes, "\n".join(rows))
+
+##############################################################################
+
+#
+# log records are put on a queue and written out by a separate thread so
+# the packet loop never waits for a slow console or journald
+#
+
+def setuplogging(levelname):
+    logqueue = queue.SimpleQueue()
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    listener = logging.handlers.QueueListener(logqueue, handler)
+
+    for oldhandler in list(logger.handlers):
+        logger.removeHandler(oldhandler)
+
+    logger.addHandler(logging.handlers.QueueHandler(logqueue))
+    logger.setLevel(levelname)
+    logger.propagate = False
+
+    listener.start()
+
+    return listener
 
 ##############################################################################
 
@@ -102,9 +261,11 @@ def senderrormessage(sock, clientip, clientport, errorcode, errormessage):
     if errormessage == "":
         errormessage = "An error has occurred"
 
-    print(progname, ": ", errorcode, ": ", errormessage, sep='', file=sys.stderr)
+    logger.warning("sending error %d to %s:%d: %s", errorcode, clientip, clientport, errormessage)
 
-    lenerrormessage = len(errormessage)
+    # the message can quote a file name with any characters in it
+    messagebytes = errormessage.encode("utf-8", errors="replace")
+    lenerrormessage = len(messagebytes)
 
     packet = bytearray(5 + lenerrormessage)
 
@@ -114,10 +275,7 @@ def senderrormessage(sock, clientip, clientport, errorcode, errormessage):
     packet[2] = 0              # error code
     packet[3] = errorcode
 
-    i = 0
-    while i < lenerrormessage:
-        packet[4 + i] = ord(errormessage[i])
-        i += 1
+    packet[4:4 + lenerrormessage] = messagebytes
 
     packet[4 + lenerrormessage] = 0
 
@@ -140,22 +298,28 @@ def unpackreadrequestdata(readrequestdata):
     
     numdatafields -= 1            # throw away the null data field always at the end
     
-    print("NUMDATA FIELDS: {}".format(numdatafields))
-    
     if numdatafields == 0:
         return "badly formed read request data - no data", "", blocksize, []
     
     if (numdatafields % 2) != 0:
         return "badly formed read request data - odd number of data fields", "", blocksize, []
 
-    filename = datafields[0].decode("utf-8")
+    try:
+        datafields = [datafield.decode("utf-8") for datafield in datafields]
+    except UnicodeDecodeError:
+        return "badly formed read request data - not valid UTF-8", "", blocksize, []
+
+    filename = datafields[0]
 
     filename = filename.replace('/', '\\')
     
-    if filename[0] == '\\':
+    if filename[0:1] == '\\':
         filename = filename[1:]
 
-    mode     = datafields[1].decode("utf-8")
+    if filename == "":
+        return "badly formed read request data - no file name", "", blocksize, []
+
+    mode     = datafields[1]
     
     if mode != "octet":
         return "only binary (octet) transfer are supported by this TFTP server implementation", "", blocksize, []
@@ -163,28 +327,46 @@ def unpackreadrequestdata(readrequestdata):
     options = []
     i = 2
     while (i < numdatafields):
-        optionname = datafields[i].decode("utf-8")
-        optionvalue = datafields[i+1].decode("utf-8")
+        optionname = datafields[i]
+        optionvalue = datafields[i+1]
         
-        # some TFP clients use "timeout" instead of interval - hack round it here!!!
-        if optionname == "timeout":
-            optionname = "interval"
-                
+        # some TFP clients use "timeout" instead of interval - both are treated the same
+        # but the OACK must echo back whichever name the client used
         if optionname == "blksize":
             try:
                 blocksize = int(optionvalue)
             except ValueError:
                 return "block size \"{}\" is not a valid integer string".format(optionvalue), "", blocksize, []
-        elif optionname == "interval":
+            if blocksize < MIN_BLOCKSIZE:
+                return "block size \"{}\" is less than {}".format(optionvalue, MIN_BLOCKSIZE), "", blocksize, []
+            # RFC 2348 - the server may answer with a smaller block size than asked for
+            blocksize = min(blocksize, MAX_BLOCKSIZE)
+            optionvalue = str(blocksize)
+        elif (optionname == "interval") or (optionname == "timeout"):
             try:
                 interval = int(optionvalue)
             except ValueError:
                 return "interval \"{}\" is not a valid integer string".format(optionvalue), "", blocksize, []
+            if (interval < 1) or (interval > 255):
+                return "interval \"{}\" is outside the range 1 to 255".format(optionvalue), "", blocksize, []
         elif optionname == "tsize":
             try:
                 tsize = int(optionvalue)
             except ValueError:
                 return "tsize \"{}\" is not a valid integer string".format(optionvalue), "", blocksize, []
+        elif optionname == "windowsize":
+            try:
+                windowsize = int(optionvalue)
+            except ValueError:
+                return "window size \"{}\" is not a valid integer string".format(optionvalue), "", blocksize, []
+            if windowsize < 1:
+                return "window size \"{}\" is less than 1".format(optionvalue), "", blocksize, []
+            # RFC 7440 - the server may answer with a smaller window than asked for
+            optionvalue = str(min(windowsize, MAX_WINDOWSIZE))
+        elif optionname == "multicast":
+            # RFC 2090 - the client sends an empty value and the server fills in the group
+            if optionvalue != "":
+                return "multicast option value \"{}\" should be empty".format(optionvalue), "", blocksize, []
         else:
             return "unsupported option \"{}\"".format(optionname), "", blocksize, []
 
@@ -196,15 +378,69 @@ def unpackreadrequestdata(readrequestdata):
 
 ##############################################################################
 
-def sendoptionack(sock, clientip, clientport, options, filesize):
+def getoption(options, optionname, defaultvalue):
+    for opt in options:
+        pair = opt.split(':')
 
-    packet = bytearray(MAX_PACKET_SIZE)
+        if pair[0] == optionname:
+            return int(pair[1])
 
-    packet[0] = 0              # option acknowledgement opcode
-    packet[1] = 6
+    return defaultvalue
+
+##############################################################################
+
+def setoption(options, optionname, optionvalue):
+    for i in range(len(options)):
+        pair = options[i].split(':')
+
+        if pair[0] == optionname:
+            options[i] = "{}:{}".format(optionname, optionvalue)
+
+##############################################################################
+
+def hasoption(options, optionname):
+    for opt in options:
+        pair = opt.split(':')
+
+        if pair[0] == optionname:
+            return True
+
+    return False
+
+##############################################################################
+
+def removeoption(options, optionname):
+    return [opt for opt in options if opt.split(':')[0] != optionname]
+
+##############################################################################
+
+#
+# the largest block that fits in one unfragmented IP packet to the client -
+# the path MTU comes from IP_MTU on the connected transfer socket (Linux)
+# and --max-blksize caps it (or stands in for it where IP_MTU is missing)
+#
+
+def maxblocksizeforsocket(sock, maxblksize):
+    maxblocksize = MAX_BLOCKSIZE
+
+    if sys.platform.startswith("linux"):
+        try:
+            mtu = sock.getsockopt(socket.IPPROTO_IP, getattr(socket, "IP_MTU", LINUX_IP_MTU))
+            maxblocksize = mtu - IP_UDP_TFTP_HEADERS
+        except OSError:
+            pass
+
+    if maxblksize > 0:
+        maxblocksize = min(maxblocksize, maxblksize)
+
+    return max(min(maxblocksize, MAX_BLOCKSIZE), MIN_BLOCKSIZE)
+
+##############################################################################
+
+def sendoptionack(sock, clientip, clientport, options, filesize):
+
+    packet = bytearray(b'\x00\x06')      # option acknowledgement opcode
 
-    i = 2
-    
     for opt in options:
         pair = opt.split(':')
         
@@ -214,29 +450,23 @@ def sendoptionack(sock, clientip, clientport, options, filesize):
         if optname == "tsize":
             optvalue = str(filesize)
         
-        for c in optname:
-            packet[i] = ord(c)
-            i += 1
-        packet[i] = 0
-        i += 1
-        
-        for c in optvalue:
-            packet[i] = ord(c)
-            i += 1
-        packet[i] = 0
-        i += 1
+        packet += optname.encode("utf-8")
+        packet.append(0)
+
+        packet += optvalue.encode("utf-8")
+        packet.append(0)
         
-    ### showpacket(packet[0:i])
+    ### showpacket(packet)
         
-    sock.sendto(packet[0:i], (clientip, clientport))
+    sock.sendto(packet, (clientip, clientport))
 
 ##############################################################################
 
-def readblock(filehandle, filesize, blocksize, blocknumber):
+def readblock(filehandle, fileoffset, filesize, blocksize, blocknumber):
     numblocksinfile = filesize // blocksize + 1
-    sizelastblock = filesize - (filesize // blocksize)
+    sizelastblock = filesize % blocksize
 
-    filehandle.seek((blocknumber - 1) * blocksize)
+    filehandle.seek(fileoffset + ((blocknumber - 1) * blocksize))
     
     if blocknumber != numblocksinfile:
         databytes = filehandle.read(blocksize)
@@ -249,172 +479,2954 @@ def readblock(filehandle, filesize, blocksize, blocknumber):
 
 ##############################################################################
 
-def senddatablock(sock, clientip, clientport, blocknumber, databytes):
-    numdatabytes = len(databytes)
+#
+# the data is a list of buffers (usually memoryview slices of a cached chunk
+# or a memory mapped file) which sendmsg() gathers straight into the packet
+# after the header so the payload is never copied in Python
+#
+# blocknumber is the logical block number which can go past 65535 - on the
+# wire it wraps round to 0 (the way iPXE and UEFI clients expect)
+#
 
-    packet = bytearray(4 + numdatabytes)
+def senddatablock(sock, clientip, clientport, blocknumber, databuffers):
+    dataheader[0] = 0              # data opcode
+    dataheader[1] = 3
+    dataheader[2] = (blocknumber // 256) % 256
+    dataheader[3] = blocknumber %  256
 
-    packet[0] = 0              # option acknowledgement opcode
-    packet[1] = 3
-    packet[2] = blocknumber // 256
-    packet[3] = blocknumber %  256
+    if hasattr(sock, "sendmsg"):
+        sock.sendmsg([dataheader] + databuffers, [], 0, (clientip, clientport))
+    else:
+        # no scatter/gather send on this platform (Windows) so join the pieces
+        sock.sendto(b''.join([dataheader] + databuffers), (clientip, clientport))
 
-    i = 4
-    while numdatabytes > 0:
-        packet[i] = databytes[i-4]
-        i += 1
-        numdatabytes -= 1
+##############################################################################
 
-    ### showpacket(packet)
-        
-    sock.sendto(packet, (clientip, clientport))
+#
+# ctypes versions of the structures used by recvmmsg() and sendmmsg()
+#
+
+class IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(IOVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+class SockAddrStorage(ctypes.Structure):
+    _fields_ = [("data", ctypes.c_ubyte * 128)]
 
 ##############################################################################
 
 #
-# Main code
+# a MultiMessageIO receives and sends batches of datagrams with one
+# recvmmsg()/sendmmsg() system call each (Linux only)
+#
+# all the ctypes structures and receive buffers are allocated once up front
+# - payload buffers must be writable (bytearray, mapfile() with writable)
+# so ctypes can take their address without copying them
 #
 
-def main():
-    parser = argparse.ArgumentParser()
+class MultiMessageIO:
+    def __init__(self, batchsize):
+        self.batchsize = batchsize
+
+        libc = ctypes.CDLL(None, use_errno=True)
+
+        self.recvmmsg = libc.recvmmsg
+        self.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        self.recvmmsg.restype = ctypes.c_int
+
+        self.sendmmsg = libc.sendmmsg
+        self.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int]
+        self.sendmmsg.restype = ctypes.c_int
+
+        # receive side - one buffer, one iovec and one address per message
+        self.recvbuffers = [bytearray(MAX_PACKET_SIZE) for i in range(batchsize)]
+        self.recvviews = [memoryview(buffer) for buffer in self.recvbuffers]
+        self.recviovecs = (IOVec * batchsize)()
+        self.recvnames = (SockAddrStorage * batchsize)()
+        self.recvmsgs = (MMsgHdr * batchsize)()
+
+        for i in range(batchsize):
+            buffer = (ctypes.c_char * MAX_PACKET_SIZE).from_buffer(self.recvbuffers[i])
+            self.recviovecs[i].iov_base = ctypes.addressof(buffer)
+            self.recviovecs[i].iov_len = MAX_PACKET_SIZE
+            self.recvmsgs[i].msg_hdr.msg_name = ctypes.addressof(self.recvnames[i])
+            self.recvmsgs[i].msg_hdr.msg_iov = ctypes.pointer(self.recviovecs[i])
+            self.recvmsgs[i].msg_hdr.msg_iovlen = 1
+
+        # send side - a header and up to two payload pieces per message
+        self.headers = bytearray(4 * batchsize)
+        self.headerbase = ctypes.addressof((ctypes.c_char * len(self.headers)).from_buffer(self.headers))
+        self.sendiovecs = (IOVec * (3 * batchsize))()
+        self.sendmsgs = (MMsgHdr * batchsize)()
+
+        for i in range(batchsize):
+            self.sendmsgs[i].msg_hdr.msg_iov = ctypes.pointer(self.sendiovecs[3 * i])
+
+    @staticmethod
+    def available():
+        if not sys.platform.startswith("linux"):
+            return False
 
-    parser.add_argument("--dir",  help="initial directory to change to", default=DEFAULT_DIRECTORY)
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+        except OSError:
+            return False
 
-    args = parser.parse_args()
+        return hasattr(libc, "recvmmsg") and hasattr(libc, "sendmmsg")
 
-    initdir = args.dir
+    def receive(self, sock):
+        # returns a list of (packet, address) tuples - empty if nothing was waiting
+        #
+        # each packet is a memoryview of a receive buffer so it is only valid
+        # until the next call
+        for i in range(self.batchsize):
+            self.recvmsgs[i].msg_hdr.msg_namelen = ctypes.sizeof(SockAddrStorage)
+            self.recvmsgs[i].msg_hdr.msg_flags = 0
 
-    try:
-        os.chdir(initdir)
-    except OSError:
-        print("{}: unable to change to initial directory \"{}\"".format(progname, initdir), file=sys.stderr)
-        sys.exit(2)
+        count = self.recvmmsg(sock.fileno(), self.recvmsgs, self.batchsize, socket.MSG_DONTWAIT, None)
 
-    # create a TCP/IP socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if count < 0:
+            errornumber = ctypes.get_errno()
+            if errornumber in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(errornumber, os.strerror(errornumber))
 
-    # bind the socket to the port
-    sock.bind(('', 69))
-    
-    # main loop for DHCP server
-    while True:
-        print("Waiting for a TFTP packet")
+        packets = []
 
-        try:
-            tftppacket, address = sock.recvfrom(MAX_PACKET_SIZE)
-        except ConnectionResetError:
-            print("{}: connecton reset error - going again".format(progname), file=sys.stderr)
-            continue
-            
-        clientip = address[0]
-        clientport = address[1]
-        packetlength = len(tftppacket)
+        for i in range(count):
+            name = bytes(self.recvnames[i].data[0:8])
+            address = (socket.inet_ntop(socket.AF_INET, name[4:8]), (name[2] * 256) + name[3])
+            packets.append((self.recvviews[i][0:self.recvmsgs[i].msg_len], address))
 
-        if packetlength < 4:
-            print("{}: packet length too short - ignoring".format(progname), file=sys.stderr)
-            showpacket(tftppacket)
-            continue
+        return packets
 
-        opcode = (tftppacket[0] * 256) + tftppacket[1]
+    def senddatablocks(self, sock, blocks):
+        # blocks is a list of (blocknumber, databuffers) - returns how many were sent
+        sent = 0
 
-        # show the packet
-        print("IP: {}   Port: {}   Opcode: {}   Length: {}".format(clientip, clientport, opcode, packetlength))
-        ### showpacket(tftppacket)
-        
-        fileopen = False
+        while sent < len(blocks):
+            batch = blocks[sent:sent + self.batchsize]
+            keepalive = []
 
-        ###############################################################################
-        # opcode 1 - read request                                                     #
-        ###############################################################################
-        if opcode == 1:
-            errmsg, filename, blocksize, options = unpackreadrequestdata(tftppacket[2:])
-            if errmsg != "":
-                senderrormessage(sock, clientip, clientport, 0, errmsg)
-                continue
-                
+            for i in range(len(batch)):
+                blocknumber, databuffers = batch[i]
+
+                self.headers[4 * i] = 0              # data opcode
+                self.headers[(4 * i) + 1] = 3
+                self.headers[(4 * i) + 2] = (blocknumber // 256) % 256
+                self.headers[(4 * i) + 3] = blocknumber %  256
+
+                iovec = self.sendiovecs[3 * i]
+                iovec.iov_base = self.headerbase + (4 * i)
+                iovec.iov_len = 4
+
+                for j in range(len(databuffers)):
+                    databuffer = databuffers[j]
+                    if memoryview(databuffer).readonly:
+                        # the readblock() fallback and read only mappings
+                        databuffer = bytearray(databuffer)
+                    cbuffer = (ctypes.c_char * len(databuffer)).from_buffer(databuffer)
+                    keepalive.append(cbuffer)
+                    iovec = self.sendiovecs[(3 * i) + 1 + j]
+                    iovec.iov_base = ctypes.addressof(cbuffer)
+                    iovec.iov_len = len(databuffer)
+
+                self.sendmsgs[i].msg_hdr.msg_iovlen = 1 + len(databuffers)
+
+            count = self.sendmmsg(sock.fileno(), self.sendmsgs, len(batch), 0)
+
+            del keepalive
+
+            if count < 0:
+                errornumber = ctypes.get_errno()
+                if errornumber in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return sent
+                raise OSError(errornumber, os.strerror(errornumber))
+
+            sent += count
+
+            if count < len(batch):
+                break
+
+        return sent
+
+##############################################################################
+
+#
+# a BlockCache holds file contents in memory for all the transfers
+#
+# files are cached in fixed size chunks keyed by (path, mtime, size, chunk
+# number) so a file that changes on disk gets a fresh set of chunks - the
+# chunks of the old version are dropped the next time the file is requested
+# and least recently used chunks are evicted when the cache is over budget
+#
+
+class BlockCache:
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.usedbytes = 0
+        self.chunks = collections.OrderedDict()
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def checkversion(self, path, mtime, size):
+        version = (mtime, size)
+
+        if self.versions.get(path, version) != version:
+            for key in [key for key in self.chunks if key[0] == path]:
+                self.usedbytes -= len(self.chunks.pop(key))
+
+        self.versions[path] = version
+
+    def getchunk(self, fileentry, chunknumber):
+        key = (fileentry.path, fileentry.mtime, fileentry.size, chunknumber)
+
+        chunk = self.chunks.get(key)
+
+        if chunk is not None:
+            self.hits += 1
+            self.chunks.move_to_end(key)
+            return chunk
+
+        self.misses += 1
+
+        # chunks are writable so the sendmmsg() batching can send straight from them -
+        # they never run past the end of the file as it may be a member of an archive
+        chunkstart = chunknumber * CACHE_CHUNK_SIZE
+        fileentry.filehandle.seek(fileentry.offset + chunkstart)
+        chunk = bytearray(max(min(CACHE_CHUNK_SIZE, fileentry.size - chunkstart), 0))
+        chunk = memoryview(chunk)[0:fileentry.filehandle.readinto(chunk)]
+
+        if len(chunk) <= self.maxbytes:
+            self.chunks[key] = chunk
+            self.usedbytes += len(chunk)
+
+            while self.usedbytes > self.maxbytes:
+                oldkey, oldchunk = self.chunks.popitem(last=False)
+                self.usedbytes -= len(oldchunk)
+
+        return chunk
+
+    def read(self, fileentry, offset, length):
+        # returns a list of one or two memoryview slices - no bytes are copied
+        chunknumber = offset // CACHE_CHUNK_SIZE
+        chunkoffset = offset % CACHE_CHUNK_SIZE
+
+        chunk = self.getchunk(fileentry, chunknumber)
+
+        if (chunkoffset + length) <= CACHE_CHUNK_SIZE:
+            return [chunk[chunkoffset:chunkoffset + length]]
+
+        # the block straddles two chunks
+        nextchunk = self.getchunk(fileentry, chunknumber + 1)
+
+        return [chunk[chunkoffset:], nextchunk[:chunkoffset + length - CACHE_CHUNK_SIZE]]
+
+##############################################################################
+
+#
+# a Histogram counts observations into cumulative buckets the way
+# Prometheus expects them
+#
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, help):
+        lines = ["# HELP {} {}".format(name, help), "# TYPE {} histogram".format(name)]
+
+        cumulative = 0
+        for i in range(len(self.buckets)):
+            cumulative += self.counts[i]
+            lines.append("{}_bucket{{le=\"{}\"}} {}".format(name, self.buckets[i], cumulative))
+
+        lines.append("{}_bucket{{le=\"+Inf\"}} {}".format(name, self.count))
+        lines.append("{}_sum {}".format(name, self.sum))
+        lines.append("{}_count {}".format(name, self.count))
+
+        return lines
+
+##############################################################################
+
+#
+# the Metrics registry is updated by the engine as packets come and go and
+# rendered in the Prometheus text format by the HTTP listener or the
+# metrics file writer thread
+#
+# the packet loop only ever adds to integers and dictionaries so no locking
+# is needed - a render running at the same time just sees slightly old numbers
+# - but a dictionary the loop can add keys to is copied (one step under the
+# GIL) before the render iterates over it in Python
+#
+
+class Metrics:
+    def __init__(self):
+        self.requests = 0
+        self.duplicaterequests = 0
+        self.requestsqueued = 0
+        self.requestsrejected = 0
+        self.pendingrequests = 0
+        self.activesessions = 0
+        self.transferscompleted = 0
+        self.transfersfailed = 0
+        self.bytessent = 0
+        self.blockssent = 0
+        self.retransmits = 0
+        self.duplicateacks = 0
+        self.errorssent = collections.Counter()
+        self.errorsreceived = collections.Counter()
+        self.filerequests = collections.Counter()
+        self.transferduration = Histogram([0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 600])
+        self.ackrtt = Histogram([0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5])
+        self.blockcache = None           # the BlockCache and SharedCache whose counters are reported
+        self.sharedcache = None
+
+    def countfilerequest(self, filename):
+        self.filerequests[filename] += 1
+
+        # do not let a scan of random file names use up memory
+        if len(self.filerequests) > MAX_TRACKED_FILES:
+            self.filerequests = collections.Counter(dict(self.filerequests.most_common(MAX_TRACKED_FILES // 2)))
+
+    def render(self):
+        lines = []
+
+        def counter(name, help, value, kind="counter"):
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            lines.append("{} {}".format(name, value))
+
+        def labelled(name, help, label, values):
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} counter".format(name))
+            for key, value in values:
+                lines.append("{}{{{}=\"{}\"}} {}".format(name, label, str(key).replace('\\', '\\\\').replace('"', '\\"'), value))
+
+        counter("rotftp_requests_total", "Read requests received.", self.requests)
+        counter("rotftp_duplicate_requests_total", "Read requests repeated by a client whose transfer had already started or was queued.", self.duplicaterequests)
+        counter("rotftp_requests_queued_total", "Read requests queued because --max-sessions transfers were running.", self.requestsqueued)
+        counter("rotftp_requests_rejected_total", "Read requests refused because the queue was full.", self.requestsrejected)
+        counter("rotftp_pending_requests", "Read requests waiting in the queue.", self.pendingrequests, "gauge")
+        counter("rotftp_active_sessions", "Transfers in progress.", self.activesessions, "gauge")
+        counter("rotftp_transfers_completed_total", "Transfers acknowledged to the last block.", self.transferscompleted)
+        counter("rotftp_transfers_failed_total", "Transfers that ended without completing.", self.transfersfailed)
+        counter("rotftp_bytes_sent_total", "DATA payload bytes sent including retransmissions.", self.bytessent)
+        counter("rotftp_blocks_sent_total", "DATA packets sent including retransmissions.", self.blockssent)
+        counter("rotftp_retransmits_total", "Retransmit timer expiries.", self.retransmits)
+        counter("rotftp_duplicate_acks_total", "Repeated or out of date ACKs ignored.", self.duplicateacks)
+        labelled("rotftp_errors_sent_total", "ERROR packets sent to clients by error code.", "code", sorted(self.errorssent.items()))
+        labelled("rotftp_errors_received_total", "ERROR packets received from clients by error code.", "code", sorted(self.errorsreceived.items()))
+        labelled("rotftp_file_requests_total", "Read requests for the most requested files.", "file", collections.Counter(dict(self.filerequests)).most_common(TOP_FILES))
+        if self.blockcache is not None:
+            counter("rotftp_cache_hits_total", "Block cache chunks found in memory.", self.blockcache.hits)
+            counter("rotftp_cache_misses_total", "Block cache chunks read from the file.", self.blockcache.misses)
+            counter("rotftp_cache_bytes", "Bytes held in the block cache.", self.blockcache.usedbytes, "gauge")
+        if self.sharedcache is not None:
+            counter("rotftp_shared_cache_hits_total", "Files found in the shared cache.", self.sharedcache.hits)
+            counter("rotftp_shared_cache_misses_total", "Files not yet in the shared cache.", self.sharedcache.misses)
+        lines.extend(self.transferduration.render("rotftp_transfer_duration_seconds", "Time from read request to last ACK."))
+        lines.extend(self.ackrtt.render("rotftp_ack_rtt_seconds", "Round trip time from sending a window to its ACK."))
+
+        return "\n".join(lines) + "\n"
+
+##############################################################################
+
+#
+# make the metrics available over HTTP on the loopback interface
+#
+
+def startmetricslistener(metrics, port):
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+
+            body = metrics.render().encode("utf-8")
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug("metrics request: " + format, *args)
+
+    server = http.server.HTTPServer(("127.0.0.1", port), MetricsRequestHandler)
+
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+
+    return server
+
+##############################################################################
+
+#
+# or rewrite a metrics file every so often (e.g. for the node exporter's
+# textfile collector) - the file is replaced in one go so readers never
+# see half of it
+#
+
+def startmetricswriter(metrics, filename):
+    def writemetrics():
+        while True:
+            temporaryfilename = filename + ".tmp"
             try:
-                filesize = os.path.getsize(filename)
-            except FileNotFoundError:
-                senderrormessage(sock, clientip, clientport, 1, "file \"{}\" not found".format(filename))
-                continue
-            
+                with open(temporaryfilename, "w") as metricsfile:
+                    metricsfile.write(metrics.render())
+                os.replace(temporaryfilename, filename)
+            except OSError as e:
+                logger.warning("unable to write metrics file \"%s\": %s", filename, e.strerror)
+            time.sleep(METRICS_FILE_INTERVAL)
+
+    thread = threading.Thread(target=writemetrics, name="metrics", daemon=True)
+    thread.start()
+
+    return thread
+
+##############################################################################
+
+#
+# a StageTimer counts how long each call of one stage of the packet loop
+# takes in power of two buckets - bucket N counts calls that took less than
+# 2**N nanoseconds, which is just int.bit_length() of the time taken
+#
+
+class StageTimer:
+    def __init__(self, name):
+        self.name = name
+        self.counts = [0] * PROFILE_BUCKETS
+        self.count = 0
+        self.totalns = 0
+        self.longestns = 0
+
+    def wrap(self, function):
+        counts = self.counts
+        lastbucket = PROFILE_BUCKETS - 1
+        perfcounter = time.perf_counter_ns
+
+        def timed(*args):
+            start = perfcounter()
             try:
-                filehandle = open(filename, "rb")
-            except FileNotFoundError:
-                senderrormessage(sock, clientip, clientport, 1, "file \"{}\" not found".format(filename))
-                continue
-                            
-            print("Filename: {}   Size: {}    Block size: {}".format(filename, filesize, blocksize))
-
-            fileopen = True
-            
-            if len(options) > 0:
-                sendoptionack(sock, clientip, clientport, options, filesize)
-                continue;
-                
-            print("Should send first data block - block size={}".format(blocksize))
-            databytes = readblock(filehandle, filesize, blocksize, 1)
-            senddatablock(sock, clientip, clientport, 1, databytes)
+                return function(*args)
+            finally:
+                elapsed = perfcounter() - start
+                counts[min(elapsed.bit_length(), lastbucket)] += 1
+                self.count += 1
+                self.totalns += elapsed
+                if elapsed > self.longestns:
+                    self.longestns = elapsed
+
+        return timed
+
+    def percentile(self, fraction):
+        # the upper bound in nanoseconds of the bucket the percentile falls in
+        # (or the longest call if that is less)
+        wanted = fraction * self.count
+        cumulative = 0
+
+        for bucket in range(PROFILE_BUCKETS):
+            cumulative += self.counts[bucket]
+            if cumulative >= wanted:
+                return min(2 ** bucket, self.longestns)
+
+        return self.longestns
 
-        ###############################################################################
-        # opcode 2 - write reqrest                                                    #
-        ###############################################################################
-        elif opcode == 2:
-            senderrormessage(sock, clientip, clientport, 0, "write request opcode 2 not supported")
+##############################################################################
 
-        ###############################################################################
-        # opcode 3 - data                                                             #
-        ###############################################################################
-        elif opcode == 3:
-            print("{}: received data block - should not be possible for a read only TFTP server", file=sys.stderr)
+#
+# with --profile the hot path methods of the engine are replaced, on that
+# one engine object, by wrappers that time every call - without --profile
+# nothing is wrapped so the packet loop carries no profiling code at all
+#
+# stages nest - "request" and "ack" include the disk reads and sends they
+# cause - so their times do not add up to the total
+#
+# the report is written on exit and whenever the process gets SIGUSR1,
+# optionally followed by cProfile statistics for every Python function
+#
 
-        ###############################################################################
-        # opcode 4 - acknowledgement                                                  #
-        ###############################################################################
-        elif opcode == 4:
-            block = (tftppacket[2] * 256) + tftppacket[3]
-            
-            if block == 0:
-                print("Should send first data block as option ack receieved ok - blocksize={}".format(blocksize))
-                databytes = readblock(filehandle, filesize, blocksize, 1)
-                senddatablock(sock, clientip, clientport, 1, databytes)
+class Profiler:
+    def __init__(self, filename, pythonprofile):
+        self.filename = filename
+        self.stages = []
+        self.starttime = time.monotonic()
+
+        if pythonprofile:
+            self.pythonprofile = cProfile.Profile()
+        else:
+            self.pythonprofile = None
+
+    def wrap(self, obj, stage, methodname):
+        timer = StageTimer(stage)
+        setattr(obj, methodname, timer.wrap(getattr(obj, methodname)))
+        self.stages.append(timer)
+
+    def instrument(self, engine):
+        for stage, methodname in PROFILE_STAGES:
+            if methodname is None:
+                self.wrap(engine.selector, stage, "select")
             else:
-                numblocksinfile = filesize // blocksize + 1
-                if block != numblocksinfile:
-                    databytes = readblock(filehandle, filesize, blocksize, block + 1)
-                    senddatablock(sock, clientip, clientport, block + 1, databytes)
-                    
-        ###############################################################################
-        # opcode 5 - error message from client                                        #
-        ###############################################################################
-        elif opcode == 5:
-            errornumber = (tftppacket[2] * 256) + tftppacket[3]
-            errormessage = "error text not present in packet data"
-            
-            if len(tftppacket) > 4:
-                strings = tftppacket[4:].split(b'\x00')
-                
-                if len(strings) >= 1:
-                    errormessage = strings[0].decode("utf-8")
-            
-            print("Error code {} from client - message reads: {}".format(errornumber, errormessage))
+                self.wrap(engine, stage, methodname)
 
-        ###############################################################################
-        # opcode 6 - option acknowledgement                                           #
-        ###############################################################################
-        elif opcode == 6:
-            print("{}: received option acknowledgement - should not be possible for a read only TFTP server", file=sys.stderr)
+        if engine.batchio is not None:
+            self.wrap(engine.batchio, "sendbatch", "senddatablocks")
+
+    def start(self):
+        if self.pythonprofile is not None:
+            self.pythonprofile.enable()
+
+    def render(self):
+        def microseconds(nanoseconds):
+            return "{:.1f}".format(nanoseconds / 1000)
+
+        lines = ["rotftp profile - process ID {} - {:.1f} seconds".format(os.getpid(), time.monotonic() - self.starttime), ""]
+
+        lines.append("{:<10} {:>10} {:>12} {:>10} {:>10} {:>10} {:>10} {:>10}".format("stage", "calls", "total ms", "mean us", "p50 us", "p90 us", "p99 us", "max us"))
+        for timer in self.stages:
+            mean = timer.totalns / timer.count if timer.count > 0 else 0
+            lines.append("{:<10} {:>10} {:>12.1f} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+                timer.name, timer.count, timer.totalns / 1000000, microseconds(mean),
+                microseconds(timer.percentile(0.5)), microseconds(timer.percentile(0.9)),
+                microseconds(timer.percentile(0.99)), microseconds(timer.longestns)))
+
+        lines.append("")
+        lines.append("percentiles are the upper bound of the histogram bucket they fall in (at most the max)")
+
+        for timer in self.stages:
+            if timer.count == 0:
+                continue
+            lines.append("")
+            lines.append("{} - calls taking less than".format(timer.name))
+            for bucket in range(PROFILE_BUCKETS):
+                if timer.counts[bucket] > 0:
+                    lines.append("  {:>14} us {:>10}".format(microseconds(2 ** bucket), timer.counts[bucket]))
+
+        return lines
+
+    def dump(self):
+        # rewrite the profile file with everything measured since the start
+        temporaryfilename = self.filename + ".tmp"
+
+        if self.pythonprofile is not None:
+            self.pythonprofile.disable()
+
+        try:
+            with open(temporaryfilename, "w") as profilefile:
+                profilefile.write("\n".join(self.render()) + "\n")
+                if self.pythonprofile is not None:
+                    profilefile.write("\n")
+                    stats = pstats.Stats(self.pythonprofile, stream=profilefile)
+                    stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+            os.replace(temporaryfilename, self.filename)
+        except OSError as e:
+            logger.warning("unable to write profile file \"%s\": %s", self.filename, e.strerror)
+        finally:
+            if self.pythonprofile is not None:
+                self.pythonprofile.enable()
+
+        logger.info("profile written to \"%s\"", self.filename)
+
+##############################################################################
+
+#
+# when a file does not exist but a compressed copy of it does (name.gz,
+# name.xz or name.zst) the copy is decompressed into a file in the spool
+# directory named after the path, mtime and size of the compressed file -
+# so it is decompressed once however many times it is asked for, by however
+# many worker processes, until the compressed file changes
+#
+
+COMPRESSED_SUFFIXES = [".gz", ".xz"]
+DECOMPRESS_ERRORS = (OSError, EOFError, zlib.error, lzma.LZMAError)
+
+if zstandard is not None:
+    COMPRESSED_SUFFIXES.append(".zst")
+    DECOMPRESS_ERRORS += (zstandard.ZstdError,)
+
+def decompressfile(source, suffix, destination):
+    with open(source, "rb") as compressed:
+        if suffix == ".zst":
+            zstandard.ZstdDecompressor().copy_stream(compressed, destination, read_size=DECOMPRESS_CHUNK_SIZE, write_size=DECOMPRESS_CHUNK_SIZE)
+            return
+
+        if suffix == ".gz":
+            decompressed = gzip.GzipFile(fileobj=compressed)
+        else:
+            decompressed = lzma.LZMAFile(compressed)
+
+        with decompressed:
+            shutil.copyfileobj(decompressed, destination, DECOMPRESS_CHUNK_SIZE)
+
+def makeprivatedirectory(directory):
+    # create directory for files only this server may write - the spool and
+    # shared cache names are easy to work out so a directory another user
+    # owns or can write to (perhaps made in /tmp before the server started)
+    # could be used to swap the files served - raises OSError if it is not safe
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    if not hasattr(os, "getuid"):
+        # no POSIX owners (Windows) - the temporary directory is per user there
+        return
+
+    directorystat = os.lstat(directory)
+
+    if not stat.S_ISDIR(directorystat.st_mode):
+        raise OSError(errno.ENOTDIR, "not a directory (or a symbolic link to one)", directory)
+
+    if directorystat.st_uid != os.getuid():
+        raise OSError(errno.EPERM, "owned by another user", directory)
+
+    if (directorystat.st_mode & (stat.S_IWGRP | stat.S_IWOTH)) != 0:
+        raise OSError(errno.EPERM, "writable by other users", directory)
+
+# spool files being made by a background thread and the reason each
+# compressed file that could not be decompressed failed (the spool name
+# changes with the compressed file so a fixed copy is tried again)
+spooling = set()
+spoolfailures = {}
+
+def spoollater(source, suffix, prefix, spoolname, spooldirectory):
+    if spoolname in spooling:
+        return
+
+    spooling.add(spoolname)
+
+    def spool():
+        try:
+            makespoolfile(source, suffix, prefix, spoolname, spooldirectory)
+        except OSError as e:
+            logger.warning("unable to decompress \"%s\": %s", source, e.strerror)
+            spoolfailures[spoolname] = e.strerror
+        finally:
+            spooling.discard(spoolname)
+
+    thread = threading.Thread(target=spool, name="spool", daemon=True)
+    thread.start()
+
+def makespoolfile(source, suffix, prefix, spoolname, spooldirectory):
+    # decompress to a temporary name and rename it into place so a
+    # half written spool file is never served
+    starttime = time.monotonic()
+    fd, temporaryname = tempfile.mkstemp(dir=spooldirectory, prefix=prefix + "-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as destination:
+            decompressfile(source, suffix, destination)
+        os.replace(temporaryname, spoolname)
+    except DECOMPRESS_ERRORS as e:
+        os.remove(temporaryname)
+        raise OSError(errno.EIO, str(e), source)
+
+    logger.info("decompressed \"%s\" to %d bytes in %.3f seconds", source, os.path.getsize(spoolname), time.monotonic() - starttime)
+
+    # remove spool files left from older versions of the compressed file
+    for oldname in glob.glob(os.path.join(spooldirectory, glob.escape(prefix) + "-*")):
+        if (oldname != spoolname) and (not oldname.endswith(".tmp")):
+            try:
+                os.remove(oldname)
+            except OSError:
+                pass
+
+def spooldecompressed(path, spooldirectory):
+    # returns (compressed file name, its stat, open decompressed file) or
+    # raises FileNotFoundError when there is no compressed copy of path
+    #
+    # the first request starts decompressing on a thread so the transfers
+    # in progress carry on - until the spool file is in place requests are
+    # refused with EAGAIN and the client is told to try again
+    for suffix in COMPRESSED_SUFFIXES:
+        source = path + suffix
+
+        try:
+            sourcestat = os.stat(source)
+        except FileNotFoundError:
+            continue
+
+        prefix = hashlib.sha1(os.fsencode(os.path.abspath(source))).hexdigest()
+        spoolname = os.path.join(spooldirectory, "{}-{}-{}".format(prefix, sourcestat.st_mtime_ns, sourcestat.st_size))
+
+        # checked every time in case the directory was removed and made again by someone else
+        try:
+            makeprivatedirectory(spooldirectory)
+        except OSError as e:
+            logger.warning("unable to use spool directory \"%s\": %s", spooldirectory, e.strerror)
+            raise
+
+        try:
+            spoolfile = open(spoolname, "rb")
+        except FileNotFoundError:
+            pass
+        else:
+            if hasattr(os, "getuid") and (os.fstat(spoolfile.fileno()).st_uid != os.getuid()):
+                spoolfile.close()
+                logger.warning("spool file \"%s\" is owned by another user - not using it", spoolname)
+                raise OSError(errno.EPERM, "spool file owned by another user", spoolname)
+            return source, sourcestat, spoolfile
+
+        if spoolname in spoolfailures:
+            raise OSError(errno.EIO, spoolfailures[spoolname], source)
+
+        spoollater(source, suffix, prefix, spoolname, spooldirectory)
+
+        raise OSError(errno.EAGAIN, "being decompressed - try again", source)
+
+    raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+
+##############################################################################
+
+#
+# files are mapped read only unless the mapping has to be writable for the
+# sendmmsg() batching - then it is a private copy on write mapping with
+# MAP_NORESERVE so no memory is set aside for copies that are never made
+# (without it a mapping bigger than RAM plus swap fails)
+#
+
+def mapfile(fileno, length, offset, writable):
+    if writable and sys.platform.startswith("linux"):
+        try:
+            return mmap.mmap(fileno, length, flags=mmap.MAP_PRIVATE | LINUX_MAP_NORESERVE, prot=mmap.PROT_READ | mmap.PROT_WRITE, offset=offset)
+        except OSError:
+            pass
+
+    return mmap.mmap(fileno, length, access=mmap.ACCESS_READ, offset=offset)
+
+##############################################################################
+
+#
+# a FileEntry is one open file shared by every transfer of that file
+#
+# the file is size bytes starting at offset in filehandle - offset is only
+# non zero for a member of an archive
+#
+# source is the file on disk that is watched for changes - normally path
+# itself but the compressed file when path is served decompressed from the
+# spool directory or the archive path is a member of
+#
+
+class FileEntry:
+    def __init__(self, path, filehandle, offset, size, mtime, source, sourcesize):
+        self.path = path
+        self.filehandle = filehandle
+        self.offset = offset
+        self.size = size
+        self.mtime = mtime
+        self.source = source
+        self.sourcesize = sourcesize
+        self.filemap = None
+        self.mapview = None
+        self.mapfailed = False
+        self.data = None
+        self.sharedmap = None
+        self.sharedview = None
+        self.users = 0
+        self.lastused = time.monotonic()
+        self.checked = time.monotonic()
+        self.watch = -1
+        self.stale = False
+
+    def getmap(self, writable):
+        # the memory mapping is made the first time a transfer needs it
+        if (self.filemap is None) and (not self.mapfailed):
+            # a mapping has to start on an allocation boundary
+            mapstart = self.offset - (self.offset % mmap.ALLOCATIONGRANULARITY)
+            try:
+                if self.size == 0:
+                    raise ValueError("cannot map an empty file")
+                self.filemap = mapfile(self.filehandle.fileno(), self.offset - mapstart + self.size, mapstart, writable)
+            except (ValueError, OSError):
+                # empty files and some special files cannot be mapped
+                self.mapfailed = True
+            else:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    self.filemap.madvise(mmap.MADV_SEQUENTIAL)
+                self.mapview = memoryview(self.filemap)[self.offset - mapstart:]
+
+        return self.mapview
+
+    def load(self):
+        # read the whole file into memory - the buffer is writable for the same sendmmsg() reason
+        data = bytearray(self.size)
+        self.filehandle.seek(self.offset)
+        self.data = memoryview(data)[0:self.filehandle.readinto(data)]
+        self.size = len(self.data)
+
+    def close(self):
+        self.data = None
+        if self.filemap is not None:
+            self.mapview.release()
+            self.filemap.close()
+        if self.sharedmap is not None:
+            self.sharedview.release()
+            self.sharedmap.close()
+        self.filehandle.close()
+
+##############################################################################
+
+#
+# the SharedCache (--shared-cache-mb) keeps whole files in a directory on a
+# memory file system that every rotftp process on the host maps - the first
+# process to send a file copies it in and the rest send DATA straight from
+# the same pages instead of each reading and caching a copy of its own
+#
+# the directory is the shared index: a copy is named after the file's
+# path, size and mtime and only appears under that name once it is
+# complete (mkstemp() then os.replace(), as in the spool directory) so a
+# process either finds the whole file or copies it in itself
+#
+# a copy removed to make room stays readable by processes that have it
+# mapped - the memory is freed when the last of them lets go
+#
+# a missing copy is made on a thread of its own so the packet loop keeps
+# going - transfers started meanwhile are sent from the file itself
+#
+
+class SharedCache:
+    def __init__(self, directory, maxbytes, writable):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.writable = writable         # map copies for sendmmsg() batching
+        self.hits = 0
+        self.misses = 0
+        self.copying = set()             # copies being made by storelater() threads
+
+        makeprivatedirectory(directory)
+
+    def attach(self, fileentry, background=True):
+        # returns a view of the shared copy of the file or None when there is
+        # none yet (one is started on a thread unless background is False, when
+        # it is made first) or the file cannot be shared
+        if fileentry.sharedview is not None:
+            return fileentry.sharedview
+
+        # big files are streamed from the page cache, which is shared already
+        if (fileentry.size == 0) or (fileentry.size > (self.maxbytes // STREAM_CACHE_FRACTION)):
+            return None
+
+        prefix = hashlib.sha1(os.fsencode("{}\0{}\0{}".format(os.path.abspath(fileentry.source), fileentry.path, fileentry.offset))).hexdigest()
+        sharedname = os.path.join(self.directory, "{}-{}-{}".format(prefix, fileentry.mtime, fileentry.size))
+
+        try:
+            try:
+                sharedfile = open(sharedname, "rb")
+                self.hits += 1
+            except FileNotFoundError:
+                self.misses += 1
+                if background and hasattr(os, "pread"):
+                    self.storelater(fileentry, prefix, sharedname)
+                    return None
+                self.store(fileentry.filehandle.fileno(), fileentry, prefix, sharedname)
+                sharedfile = open(sharedname, "rb")
+
+            with sharedfile:
+                sharedstat = os.fstat(sharedfile.fileno())
+                if sharedstat.st_size != fileentry.size:
+                    return None
+                if hasattr(os, "getuid") and (sharedstat.st_uid != os.getuid()):
+                    logger.warning("shared cache copy \"%s\" is owned by another user - not using it", sharedname)
+                    return None
+                fileentry.sharedmap = mapfile(sharedfile.fileno(), fileentry.size, 0, self.writable)
+        except OSError as e:
+            logger.warning("unable to use the shared cache for \"%s\": %s", fileentry.path, e.strerror)
+            return None
+
+        fileentry.sharedview = memoryview(fileentry.sharedmap)
+
+        return fileentry.sharedview
+
+    def storelater(self, fileentry, prefix, sharedname):
+        if sharedname in self.copying:
+            return
+
+        # the thread has its own descriptor in case the entry is closed first
+        # and reads with pread() so the file offset the loop uses is untouched
+        sourcefd = os.dup(fileentry.filehandle.fileno())
+        self.copying.add(sharedname)
+
+        def copy():
+            try:
+                self.store(sourcefd, fileentry, prefix, sharedname)
+            except OSError as e:
+                logger.warning("unable to copy \"%s\" into the shared cache: %s", fileentry.path, e.strerror)
+            finally:
+                os.close(sourcefd)
+                self.copying.discard(sharedname)
+
+        thread = threading.Thread(target=copy, name="sharedcache", daemon=True)
+        thread.start()
+
+    def store(self, sourcefd, fileentry, prefix, sharedname):
+        self.makeroom(fileentry.size)
+
+        fd, temporaryname = tempfile.mkstemp(dir=self.directory, prefix=prefix + "-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as destination:
+                offset = fileentry.offset
+                remaining = fileentry.size
+                while remaining > 0:
+                    if hasattr(os, "pread"):
+                        chunk = os.pread(sourcefd, min(remaining, DECOMPRESS_CHUNK_SIZE), offset)
+                    else:
+                        os.lseek(sourcefd, offset, os.SEEK_SET)
+                        chunk = os.read(sourcefd, min(remaining, DECOMPRESS_CHUNK_SIZE))
+                    if len(chunk) == 0:
+                        raise OSError(errno.EIO, "\"{}\" is shorter than expected".format(fileentry.path))
+                    destination.write(chunk)
+                    offset += len(chunk)
+                    remaining -= len(chunk)
+            os.replace(temporaryname, sharedname)
+        except OSError:
+            os.remove(temporaryname)
+            raise
+
+        logger.info("copied \"%s\" (%d bytes) into the shared cache", fileentry.path, fileentry.size)
+
+        # remove copies of older versions of the file
+        for oldname in glob.glob(os.path.join(self.directory, glob.escape(prefix) + "-*")):
+            if (oldname != sharedname) and (not oldname.endswith(".tmp")):
+                try:
+                    os.remove(oldname)
+                except OSError:
+                    pass
+
+    def makeroom(self, size):
+        # remove the copies made longest ago until size more bytes fit
+        copies = []
+        usedbytes = 0
+
+        for name in os.listdir(self.directory):
+            try:
+                copystat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            copies.append((copystat.st_mtime_ns, name, copystat.st_size))
+            usedbytes += copystat.st_size
+
+        copies.sort()
+
+        for mtime, name, copysize in copies:
+            if usedbytes + size <= self.maxbytes:
+                break
+            if name.endswith(".tmp"):
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            usedbytes -= copysize
+
+##############################################################################
+
+#
+# a file backend finds the file behind a requested name and opens it as a
+# FileEntry (raising OSError when it cannot) - match() lists the names
+# matching a --preload pattern
+#
+# the FileSystemBackend serves the current directory (--dir) and the
+# ArchiveBackend serves the members of one tar or zip archive (--archive)
+#
+
+class FileSystemBackend:
+    def __init__(self, spooldirectory, root):
+        # raises OSError if the spool directory is not safe to use
+        self.spooldirectory = spooldirectory
+        self.root = root
+
+        makeprivatedirectory(spooldirectory)
+
+    def open(self, path):
+        fullpath = os.path.join(self.root, path)
+
+        try:
+            filehandle = open(fullpath, "rb")
+            source = fullpath
+            sourcestat = os.fstat(filehandle.fileno())
+        except FileNotFoundError:
+            source, sourcestat, filehandle = spooldecompressed(fullpath, self.spooldirectory)
+
+        size = os.fstat(filehandle.fileno()).st_size
+
+        return FileEntry(path, filehandle, 0, size, sourcestat.st_mtime_ns, source, sourcestat.st_size)
+
+    def match(self, pattern):
+        paths = sorted(glob.glob(os.path.join(self.root, pattern)))
+
+        return [os.path.relpath(path, self.root) for path in paths if os.path.isfile(path)]
+
+##############################################################################
+
+#
+# members of the archive are found in an index of name -> (offset, size)
+# built when the server starts - every member entry reads from its own
+# duplicate of the archive file descriptor so the archive can be replaced
+# with a new release while transfers from the old one finish
+#
+# only members stored without compression can be read by offset - tar
+# archives must not be compressed as a whole and zip members must be stored
+#
+# member names are looked up the same way request file names are written
+# (with '\' for '/' and no leading slash)
+#
+
+class ArchiveBackend:
+    def __init__(self, archivepath):
+        self.archivepath = archivepath
+        self.archive = None
+        self.index = {}
+        self.version = None
+        self.loadindex()
+
+    def loadindex(self):
+        # raises OSError when the archive cannot be read
+        archive = open(self.archivepath, "rb")
+        archivestat = os.fstat(archive.fileno())
+
+        try:
+            if zipfile.is_zipfile(archive):
+                index, skipped = self.indexzip(archive)
+            else:
+                archive.seek(0)
+                index, skipped = self.indextar(archive)
+        except (tarfile.TarError, zipfile.BadZipFile, struct.error) as e:
+            archive.close()
+            raise OSError(errno.EINVAL, "unable to read archive \"{}\": {}".format(self.archivepath, e))
+
+        if self.archive is not None:
+            self.archive.close()
+
+        self.archive = archive
+        self.index = index
+        self.version = (archivestat.st_mtime_ns, archivestat.st_size)
+
+        logger.info("serving %d files from archive \"%s\"", len(index), self.archivepath)
+        if skipped > 0:
+            logger.warning("%d compressed or sparse members of archive \"%s\" cannot be served", skipped, self.archivepath)
+
+    def indextar(self, archive):
+        index = {}
+        skipped = 0
+
+        # "r:" refuses a compressed archive - its members have no offset to read from
+        with tarfile.open(fileobj=archive, mode="r:") as tar:
+            for member in tar:
+                if not member.isreg():
+                    continue
+                if member.issparse():
+                    # only the non-zero parts are stored so the data cannot be read in place
+                    skipped += 1
+                    continue
+                index[self.membername(member.name)] = (member.offset_data, member.size)
+
+        return index, skipped
+
+    def indexzip(self, archive):
+        index = {}
+        skipped = 0
+
+        with zipfile.ZipFile(archive) as zip:
+            for member in zip.infolist():
+                if member.is_dir():
+                    continue
+                if member.compress_type != zipfile.ZIP_STORED:
+                    skipped += 1
+                    continue
+                # the data follows the local header whose name and extra field
+                # lengths can differ from the central directory
+                archive.seek(member.header_offset)
+                localheader = archive.read(30)
+                namelength, extralength = struct.unpack("<HH", localheader[26:30])
+                index[self.membername(member.filename)] = (member.header_offset + 30 + namelength + extralength, member.file_size)
+
+        return index, skipped
+
+    def membername(self, name):
+        name = name.replace('/', '\\')
+
+        while name.startswith(".\\"):
+            name = name[2:]
+
+        return name.lstrip('\\')
+
+    def open(self, path):
+        # a new archive (a new release swapped in) is indexed again
+        archivestat = os.stat(self.archivepath)
+        if (archivestat.st_mtime_ns, archivestat.st_size) != self.version:
+            self.loadindex()
+
+        member = self.index.get(path)
+        if member is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+
+        filehandle = os.fdopen(os.dup(self.archive.fileno()), "rb")
+
+        return FileEntry(path, filehandle, member[0], member[1], self.version[0], self.archivepath, self.version[1])
+
+    def match(self, pattern):
+        return sorted(fnmatch.filter(self.index.keys(), self.membername(pattern)))
+
+##############################################################################
+
+#
+# a FileHandleCache keeps files open between requests so a request for a
+# file that was recently served needs no stat() or open() - which matters
+# when --dir is on NFS
+#
+# on Linux an inotify watch on each open file drops its entry as soon as
+# the file is changed, replaced or removed - elsewhere each entry is
+# checked with stat() when it has not been checked for a couple of seconds
+#
+# files nobody has asked for in a while are closed, as are the least
+# recently used ones if too many are open - except preloaded files which
+# are held in memory for good and read in again when they change
+#
+
+class FileHandleCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.entries = collections.OrderedDict()
+        self.watches = {}
+        self.preloads = set()
+        self.sharedcache = None
+        self.inotifyfd = -1
+
+        if sys.platform.startswith("linux"):
+            try:
+                self.libc = ctypes.CDLL(None, use_errno=True)
+                self.inotifyfd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            except (OSError, AttributeError):
+                self.inotifyfd = -1
+
+        if self.inotifyfd >= 0:
+            # inotify does not see changes made on other NFS clients so check now and again anyway
+            self.recheckinterval = HANDLE_INOTIFY_RECHECK
+        else:
+            self.recheckinterval = HANDLE_POLL_INTERVAL
+
+    def fileno(self):
+        return self.inotifyfd
+
+    def open(self, path):
+        # returns the FileEntry for path (raising OSError if it cannot be opened) -
+        # every open() must be matched by a release()
+        now = time.monotonic()
+
+        entry = self.entries.get(path)
+
+        if (entry is not None) and ((now - entry.checked) > self.recheckinterval):
+            try:
+                filestat = os.stat(entry.source)
+                if (filestat.st_mtime_ns != entry.mtime) or (filestat.st_size != entry.sourcesize):
+                    self.invalidate(entry)
+                    entry = None
+                else:
+                    entry.checked = now
+            except OSError:
+                self.invalidate(entry)
+                entry = None
+
+        if entry is None:
+            entry = self.backend.open(path)
+            if hasattr(os, "posix_fadvise"):
+                try:
+                    os.posix_fadvise(entry.filehandle.fileno(), entry.offset, entry.size, os.POSIX_FADV_SEQUENTIAL)
+                except OSError:
+                    pass
+            if path in self.preloads:
+                try:
+                    # preloaded files are held in the shared cache when there is one
+                    if (self.sharedcache is None) or (self.sharedcache.attach(entry, False) is None):
+                        entry.load()
+                except OSError:
+                    entry.filehandle.close()
+                    raise
+            self.addwatch(entry)
+            self.entries[path] = entry
+            self.trim()
+
+        self.entries.move_to_end(path)
+        entry.users += 1
+        entry.lastused = now
+
+        return entry
+
+    def preload(self, path):
+        # returns the number of bytes held in memory
+        self.preloads.add(path)
+        entry = self.open(path)
+        self.release(entry)
+        return entry.size
+
+    def release(self, entry):
+        entry.users -= 1
+        entry.lastused = time.monotonic()
+
+        if entry.stale and (entry.users == 0):
+            entry.close()
+
+    def invalidate(self, entry):
+        if self.entries.get(entry.path) is entry:
+            del self.entries[entry.path]
+
+        if entry.watch >= 0:
+            # the watch is removed with the last entry using it
+            watched = self.watches.get(entry.watch)
+            if watched is not None:
+                watched.discard(entry)
+                if len(watched) == 0:
+                    del self.watches[entry.watch]
+                    self.libc.inotify_rm_watch(self.inotifyfd, entry.watch)
+            entry.watch = -1
+
+        entry.stale = True
+
+        if entry.users == 0:
+            entry.close()
+
+    def addwatch(self, entry):
+        if self.inotifyfd < 0:
+            return
+
+        mask = INOTIFY_MODIFY | INOTIFY_ATTRIB | INOTIFY_CLOSE_WRITE | INOTIFY_MOVE_SELF | INOTIFY_DELETE_SELF
+
+        watch = self.libc.inotify_add_watch(self.inotifyfd, os.fsencode(os.path.abspath(entry.source)), mask)
+
+        if watch >= 0:
+            # entries for the same file under other names (or for other
+            # members of the same archive) share the watch
+            entry.watch = watch
+            self.watches.setdefault(watch, set()).add(entry)
+
+    def readevents(self):
+        # called when the inotify descriptor is readable
+        while True:
+            try:
+                events = os.read(self.inotifyfd, 65536)
+            except (BlockingIOError, InterruptedError):
+                return
+
+            offset = 0
+            while offset < len(events):
+                watch, mask, cookie, namelength = inotifyevent.unpack_from(events, offset)
+                offset += inotifyevent.size + namelength
+
+                for entry in list(self.watches.get(watch, ())):
+                    logger.debug("\"%s\" changed - dropping its cached file handle", entry.path)
+                    self.invalidate(entry)
+
+    def close(self):
+        for entry in list(self.entries.values()):
+            self.invalidate(entry)
+
+        if self.inotifyfd >= 0:
+            os.close(self.inotifyfd)
+            self.inotifyfd = -1
+
+    def trim(self):
+        # close files nobody is using once there are too many open
+        for entry in list(self.entries.values()):
+            if len(self.entries) <= MAX_OPEN_FILES:
+                break
+            if (entry.users == 0) and (entry.path not in self.preloads):
+                self.invalidate(entry)
+
+    def expire(self):
+        now = time.monotonic()
+
+        for entry in list(self.entries.values()):
+            if (entry.users == 0) and (entry.path not in self.preloads) and ((now - entry.lastused) > OPEN_FILE_IDLE_TIMEOUT):
+                self.invalidate(entry)
+
+##############################################################################
+
+#
+# a TokenBucket limits a flow of bytes to rate bytes per second with short
+# bursts - it is always big enough for the largest DATA packet
+#
+
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.burst = max(rate * BUCKET_BURST_SECONDS, MAX_BLOCKSIZE + 4)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.tokens + ((now - self.updated) * self.rate), self.burst)
+        self.updated = now
+
+    def wait(self, nbytes):
+        # seconds until nbytes can be taken
+        return max(nbytes - self.tokens, 0) / self.rate
+
+##############################################################################
+
+#
+# the FairScheduler decides which transfer sends next when --max-rate or
+# --per-client-rate limit the bandwidth
+#
+# a transfer with a window to send waits in a ready queue and each round
+# (deficit round robin) it may send up to SCHEDULER_QUANTUM bytes - so one
+# client fetching an ISO image gets the same share as each of the clients
+# fetching small files - as long as there are tokens in the global bucket
+# and the bucket of its client IP address
+#
+# files no bigger than --priority-size have their own ready queue which is
+# served first so the small early boot stages stay quick under load
+#
+
+class FairScheduler:
+    def __init__(self, maxrate, perclientrate, prioritysize):
+        if maxrate > 0:
+            self.globalbucket = TokenBucket(maxrate)
+        else:
+            self.globalbucket = None
+        self.perclientrate = perclientrate
+        self.clientbuckets = {}
+        self.prioritysize = prioritysize
+        self.ready = [collections.deque(), collections.deque()]    # small files, everything else
+        self.wakeup = None
+
+    def clientbucket(self, clientip):
+        if self.perclientrate <= 0:
+            return None
+
+        bucket = self.clientbuckets.get(clientip)
+
+        if bucket is None:
+            bucket = TokenBucket(self.perclientrate)
+            self.clientbuckets[clientip] = bucket
+
+        return bucket
+
+    def enqueue(self, session):
+        if session.queued:
+            return
+
+        session.queued = True
+        session.deficit = 0
+
+        if session.filesize <= self.prioritysize:
+            self.ready[0].append(session)
+        else:
+            self.ready[1].append(session)
+
+    def expire(self):
+        now = time.monotonic()
+
+        for clientip, bucket in list(self.clientbuckets.items()):
+            if (now - bucket.updated) > BUCKET_IDLE_TIMEOUT:
+                del self.clientbuckets[clientip]
+
+##############################################################################
+
+#
+# a Session holds the state of one read transfer
+#
+# each session has its own socket bound to an ephemeral port (the RFC 1350
+# transfer identifier) and connected to the client's address and port so
+# the kernel only hands us packets from that client
+#
+
+class Session:
+    def __init__(self, sock, clientip, clientport, filename, fileentry, filemap, cached, blocksize, windowsize, options, timeout):
+        self.sock = sock
+        self.clientip = clientip
+        self.clientport = clientport
+        self.dataip = clientip           # where DATA packets go
+        self.dataport = clientport
+        self.multicast = False
+        self.filename = filename
+        self.fileentry = fileentry
+        self.filehandle = fileentry.filehandle
+        self.cached = cached
+        if filemap is not None:
+            self.fileview = memoryview(filemap)
+        else:
+            self.fileview = None
+        self.filesize = fileentry.size
+        self.filemtime = fileentry.mtime
+        filesize = fileentry.size
+        self.blocksize = blocksize
+        self.numblocks = filesize // blocksize + 1
+        self.windowsize = windowsize
+        self.lastacked = 0
+        self.lastsent = 0
+        self.nextblock = 1               # blocks nextblock to windowend are waiting in the scheduler
+        self.windowend = 0
+        self.queued = False
+        self.deficit = 0
+        if fileentry.data is not None:
+            self.readahead = filesize    # already in memory
+        else:
+            self.readahead = 0           # the file offset the kernel has been asked to read up to
+        self.options = options
+        self.oackpending = len(options) > 0
+        self.closed = False
+        self.completed = False
+
+        # totals for the summary logged at the end of the transfer
+        self.starttime = time.monotonic()
+        self.blockssent = 0
+        self.bytessent = 0
+        self.retransmits = 0
+        self.duplicateacks = 0
+
+        # retransmission state - the timeout starts at the negotiated value and
+        # then follows the measured round trip time (RFC 6298 style) but never
+        # goes above the negotiated value unless backing off after a loss
+        #
+        # the adaptive timeout only paces retransmissions - a transfer is given
+        # up after MAX_RETRIES of them and no new ACK for at least MAX_RETRIES
+        # times the negotiated timeout, however short the round trip time is
+        self.maxtimeout = timeout
+        self.timeout = timeout
+        self.srtt = None
+        self.rttvar = None
+        self.retries = 0
+        self.lastheard = time.monotonic()    # when the client last acknowledged something new
+        self.retransmitted = False
+        self.senttime = 0.0
+        self.deadline = 0.0
+
+    def logicalblock(self, wireblock):
+        # turn a 16 bit block number from an ACK into a logical block number -
+        # it must be at or after the last ACK and no later than the last block sent
+        block = self.lastacked + ((wireblock - self.lastacked) % 65536)
+
+        if block > self.lastsent:
+            # an old ACK from before the block number last wrapped round
+            block -= 65536
+
+        return block
+
+    def updatertt(self, sample):
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = (0.75 * self.rttvar) + (0.25 * abs(self.srtt - sample))
+            self.srtt = (0.875 * self.srtt) + (0.125 * sample)
+
+        self.timeout = min(max(self.srtt + (4 * self.rttvar), MIN_TIMEOUT), self.maxtimeout)
+
+    def timedout(self, now):
+        return (self.retries >= MAX_RETRIES) and ((now - self.lastheard) >= (MAX_RETRIES * self.maxtimeout))
+
+    def backoff(self):
+        self.retries += 1
+        self.retransmits += 1
+        self.retransmitted = True
+        self.timeout = min(self.timeout * 2, MAX_TIMEOUT)
+
+    def close(self):
+        # the file itself belongs to the FileHandleCache
+        self.closed = True
+        if self.fileview is not None:
+            self.fileview.release()
+        self.sock.close()
+
+##############################################################################
+
+#
+# a MulticastSession is an RFC 2090 transfer of one file at one block size
+# to every client that asks for it with the multicast option
+#
+# DATA packets go to the group address - each client joins the group - but
+# only the master client sends ACKs so the transfer runs at the pace of one
+# client.  When the master has the whole file (or stops answering) the
+# client that has waited longest becomes the master.  It ACKs the block
+# before the first one it is missing so a client that joined part way
+# through gets the blocks it missed sent again
+#
+# the session socket is not connected - the master client changes and the
+# other clients send their OACK acknowledgements and final ACKs to it too
+#
+
+class MulticastSession(Session):
+    def __init__(self, sock, groupip, groupport, filename, fileentry, filemap, cached, blocksize, timeout):
+        Session.__init__(self, sock, None, 0, filename, fileentry, filemap, cached, blocksize, 1, [], timeout)
+        self.multicast = True
+        self.groupip = groupip
+        self.groupport = groupport
+        self.dataip = groupip
+        self.dataport = groupport
+        self.members = collections.OrderedDict()    # (ip, port) -> the options each client asked for
+        self.clientsserved = 0
+
+    def optionsfor(self, address, master):
+        options = list(self.members[address])
+        setoption(options, "multicast", "{},{},{}".format(self.groupip, self.groupport, int(master)))
+        return options
+
+    def ismaster(self, address):
+        return address == (self.clientip, self.clientport)
+
+    def electmaster(self):
+        # the client that has waited longest - retransmission starts afresh for it
+        address = next(iter(self.members))
+        self.clientip = address[0]
+        self.clientport = address[1]
+        self.options = self.optionsfor(address, True)
+        self.oackpending = True
+        self.timeout = self.maxtimeout
+        self.srtt = None
+        self.rttvar = None
+        self.retries = 0
+        self.lastheard = time.monotonic()
+        self.retransmitted = False
+
+##############################################################################
+
+#
+# the TransferEngine runs all the sessions from a single selector loop
+#
+# the well known port socket only ever sees new requests - everything
+# else for a transfer arrives on that transfer's own socket
+#
+
+class TransferEngine:
+    def __init__(self, cache, batchio, metrics, maxblksize, backend, scheduler):
+        self.cache = cache
+        self.scheduler = scheduler
+        self.handlecache = FileHandleCache(backend)
+        self.nextexpiry = time.monotonic() + EXPIRY_INTERVAL
+        self.maxblksize = maxblksize
+        self.batchio = batchio
+        self.metrics = metrics
+        self.metrics.blockcache = cache
+        self.logpackets = logger.isEnabledFor(logging.DEBUG)
+        self.selector = selectors.DefaultSelector()
+        self.sessions = {}
+
+        if self.handlecache.fileno() >= 0:
+            self.watch(self.handlecache, self.handlecache)
+        self.timers = []
+        self.timersequence = 0
+        self.multicastgroups = {}
+        self.multicastaddresses = None
+        self.requestsessions = {}
+        self.pending = collections.OrderedDict()
+        self.maxsessions = 0
+        self.maxpending = 0
+        self.maxwindowsize = MAX_WINDOWSIZE
+        self.sharedcache = None
+        self.recvbuffer = bytearray(MAX_PACKET_SIZE)
+        self.recvview = memoryview(self.recvbuffer)
+        self.sessionstarted = None       # hooks called with the Session when a transfer starts and ends
+        self.sessionended = None
+        self.listensockets = []
+        self.stopping = False
+        self.stopdeadline = 0.0
+
+    def addlistensocket(self, sock):
+        sock.setblocking(False)
+        self.watch(sock, None)
+        self.listensockets.append(sock)
+
+    def watch(self, fileobj, data):
+        # data is None for a listening socket, the FileHandleCache for its
+        # inotify descriptor and otherwise the Session the socket belongs to
+        self.selector.register(fileobj, selectors.EVENT_READ, data)
+
+    def unwatch(self, fileobj):
+        self.selector.unregister(fileobj)
+
+    def notify(self, hook, session):
+        if hook is None:
+            return
+
+        try:
+            hook(session)
+        except Exception:
+            logger.exception("session hook failed")
+
+    def limitsessions(self, maxsessions, maxpending):
+        # at most maxsessions transfers at once - up to maxpending more requests wait
+        # for a free slot and any more than that are turned away straight away
+        self.maxsessions = maxsessions
+        self.maxpending = maxpending
+
+    def enablesharedcache(self, directory, maxbytes):
+        # raises OSError if the directory cannot be made
+        self.sharedcache = SharedCache(directory, maxbytes, self.batchio is not None)
+        self.metrics.sharedcache = self.sharedcache
+        self.handlecache.sharedcache = self.sharedcache
+
+    def enablemulticast(self, address, port, ttl, interface, first, step):
+        # worker processes each hand out a different share of the addresses
+        self.multicastaddresses = [str(ipaddress.IPv4Address(address) + i) for i in range(first, MULTICAST_GROUPS, step)]
+        self.multicastport = port
+        self.multicastttl = ttl
+        self.multicastinterface = interface
+
+        # DATA packets to the group have to fit the MTU of the route to it
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            probe.connect((address, port))
+            self.multicastmaxblocksize = maxblocksizeforsocket(probe, self.maxblksize)
+        except OSError:
+            self.multicastmaxblocksize = maxblocksizeforsocket(probe, self.maxblksize)
+        finally:
+            probe.close()
+
+    def shutdown(self):
+        # the first call stops new requests and lets active transfers finish -
+        # a second call abandons the active transfers as well
+        if self.stopping:
+            self.stopdeadline = 0.0
+            return
+
+        self.stopping = True
+        self.stopdeadline = time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT
+
+    def run(self):
+        while not self.checkstopping():
+            events = self.selector.select(self.nexttimeout())
+
+            for key, mask in events:
+                self.dispatch(key.fileobj, key.data)
+
+            self.housekeeping()
+
+        self.close()
+
+    def close(self):
+        if self.handlecache.fileno() >= 0:
+            self.unwatch(self.handlecache)
+        self.handlecache.close()
+        self.selector.close()
+
+    def checkstopping(self):
+        # returns True once a shutdown has finished
+        if not self.stopping:
+            return False
+
+        if len(self.listensockets) > 0:
+            logger.info("shutting down - waiting for %d active transfers to finish", len(self.sessions))
+            for sock in self.listensockets:
+                self.unwatch(sock)
+                sock.close()
+            self.listensockets = []
+            self.pending.clear()
+            self.metrics.pendingrequests = 0
+
+        if time.monotonic() >= self.stopdeadline:
+            for session in list(self.sessions.values()):
+                self.senderror(session.sock, session.clientip, session.clientport, 0, "server shutting down")
+                self.endsession(session)
+
+        return len(self.sessions) == 0
+
+    def dispatch(self, fileobj, data):
+        if data is None:
+            self.handlelistensocket(fileobj)
+        elif data is self.handlecache:
+            self.handlecache.readevents()
+        else:
+            self.handlesessionsocket(data)
+
+    def housekeeping(self):
+        # the work due after every pass of the loop
+        self.runtimers()
+
+        if self.scheduler is not None:
+            self.runscheduler()
+
+        if len(self.pending) > 0:
+            self.startpending()
+
+        if time.monotonic() >= self.nextexpiry:
+            if len(self.pending) > 0:
+                self.expirepending()
+            self.handlecache.expire()
+            if self.scheduler is not None:
+                self.scheduler.expire()
+            self.nextexpiry = time.monotonic() + EXPIRY_INTERVAL
+
+    def receive(self, sock):
+        # returns a list of (packet, address) tuples - several at once when batching
+        #
+        # packets are memoryviews of buffers reused by the next receive so
+        # nothing is allocated for the stream of 4 byte ACKs - anything kept
+        # longer (a read request waiting for a free session) must be copied
+        if self.batchio is not None:
+            return self.batchio.receive(sock)
+
+        try:
+            packetlength, address = sock.recvfrom_into(self.recvbuffer)
+        except (BlockingIOError, InterruptedError):
+            return []
+
+        return [(self.recvview[0:packetlength], address)]
+
+    def handlelistensocket(self, sock):
+        try:
+            packets = self.receive(sock)
+        except ConnectionResetError:
+            logger.warning("connecton reset error - going again")
+            return
+
+        for tftppacket, address in packets:
+            if self.stopping:
+                break
+            self.handlelistenpacket(sock, tftppacket, address)
+
+    def handlelistenpacket(self, sock, tftppacket, address):
+        clientip = address[0]
+        clientport = address[1]
+        packetlength = len(tftppacket)
+
+        if packetlength < 4:
+            logger.warning("packet length too short from %s:%d - ignoring", clientip, clientport)
+            if self.logpackets:
+                showpacket(tftppacket)
+            return
+
+        opcode, block = packetheader.unpack_from(tftppacket)
+
+        if self.logpackets:
+            logger.debug("IP: %s   Port: %d   Opcode: %d   Length: %d", clientip, clientport, opcode, packetlength)
+
+        ###############################################################################
+        # opcode 1 - read request                                                     #
+        ###############################################################################
+        if opcode == 1:
+            self.startsession(sock, clientip, clientport, bytes(tftppacket))
+
+        ###############################################################################
+        # opcode 2 - write reqrest                                                    #
+        ###############################################################################
+        elif opcode == 2:
+            self.senderror(sock, clientip, clientport, 0, "write request opcode 2 not supported")
+
+        ###############################################################################
+        # any other opcode belongs to a transfer and should go to its own port        #
+        ###############################################################################
+        else:
+            self.senderror(sock, clientip, clientport, 5, "unknown transfer ID - opcode {} sent to the server port".format(opcode))
+
+    def startsession(self, listensock, clientip, clientport, tftppacket, queued=False):
+        errmsg, filename, blocksize, options = unpackreadrequestdata(tftppacket[2:])
+        if errmsg != "":
+            self.senderror(listensock, clientip, clientport, 0, errmsg)
+            return
+
+        requestkey = (clientip, clientport, filename)
+
+        # a client that heard nothing back yet sends its request again - that
+        # must not start a second transfer to the same port
+        session = self.requestsessions.get(requestkey)
+        if session is not None:
+            self.metrics.duplicaterequests += 1
+            logger.debug("repeated request for \"%s\" from %s:%d - already being sent", filename, clientip, clientport)
+            if (session.lastacked == 0) and (not session.queued):
+                # nothing acknowledged yet so the OACK or first window was probably
+                # lost - the ACK that follows may answer either copy so it must
+                # not be timed (Karn's algorithm)
+                session.retransmitted = True
+                self.transmit(session)
+            return
+
+        if requestkey in self.pending:
+            self.metrics.duplicaterequests += 1
+            self.pending[requestkey] = (listensock, tftppacket, time.monotonic())
+            return
+
+        if not queued:
+            self.metrics.requests += 1
+            self.metrics.countfilerequest(filename)
+
+        if (self.maxsessions > 0) and (len(self.sessions) >= self.maxsessions):
+            if len(self.pending) >= self.maxpending:
+                self.expirepending()
+            if len(self.pending) >= self.maxpending:
+                self.metrics.requestsrejected += 1
+                self.senderror(listensock, clientip, clientport, 0, "server busy - too many transfers in progress")
+                return
+
+            self.metrics.requestsqueued += 1
+            self.pending[requestkey] = (listensock, tftppacket, time.monotonic())
+            self.metrics.pendingrequests = len(self.pending)
+            logger.debug("request for \"%s\" from %s:%d queued - %d waiting", filename, clientip, clientport, len(self.pending))
+            return
+
+        try:
+            fileentry = self.handlecache.open(filename)
+        except FileNotFoundError:
+            self.senderror(listensock, clientip, clientport, 1, "file \"{}\" not found".format(filename))
+            return
+        except PermissionError:
+            self.senderror(listensock, clientip, clientport, 2, "access to file \"{}\" denied".format(filename))
+            return
+        except OSError as e:
+            self.senderror(listensock, clientip, clientport, 0, "unable to open file \"{}\": {}".format(filename, e.strerror))
+            return
+
+        if hasoption(options, "multicast"):
+            if self.joinmulticast(listensock, clientip, clientport, filename, fileentry, blocksize, options):
+                return
+            # the option is left out of the OACK and the client falls back to a normal transfer
+            options = removeoption(options, "multicast")
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        try:
+            sock.bind(('', 0))
+            sock.connect((clientip, clientport))
+            sock.setblocking(False)
+        except OSError as e:
+            self.handlecache.release(fileentry)
+            sock.close()
+            self.senderror(listensock, clientip, clientport, 0, "unable to create transfer socket: {}".format(e.strerror))
+            return
+
+        filesize = fileentry.size
+
+        # keep DATA packets inside the path MTU - fragmented blocks are lost
+        # whole when any one fragment is lost
+        # only a negotiated block size can be reduced - a client that did not
+        # ask for blksize expects 512 byte blocks whatever the path MTU
+        maxblocksize = maxblocksizeforsocket(sock, self.maxblksize)
+        if hasoption(options, "blksize") and (blocksize > maxblocksize):
+            logger.debug("block size %d from %s:%d reduced to %d to fit the path MTU", blocksize, clientip, clientport, maxblocksize)
+            blocksize = maxblocksize
+            setoption(options, "blksize", blocksize)
+
+        cached, filemap = self.filesource(filename, fileentry)
+
+        windowsize = getoption(options, "windowsize", DEFAULT_WINDOWSIZE)
+        if windowsize > self.maxwindowsize:
+            windowsize = self.maxwindowsize
+            setoption(options, "windowsize", windowsize)
+        timeout = getoption(options, "timeout", getoption(options, "interval", DEFAULT_TIMEOUT))
+
+        session = Session(sock, clientip, clientport, filename, fileentry, filemap, cached, blocksize, windowsize, options, timeout)
+
+        self.sessions[sock.fileno()] = session
+        self.requestsessions[requestkey] = session
+        self.watch(sock, session)
+        self.metrics.activesessions += 1
+
+        logger.info("sending \"%s\" to %s:%d   Size: %d   Block size: %d   Window size: %d   Port: %d   Active: %d", filename, clientip, clientport, filesize, blocksize, windowsize, sock.getsockname()[1], len(self.sessions))
+
+        self.notify(self.sessionstarted, session)
+
+        self.transmit(session)
+
+    def expirepending(self):
+        # forget queued requests the client has stopped repeating - a repeat
+        # refreshes the time but keeps its place so the whole queue is checked
+        now = time.monotonic()
+
+        for requestkey, (listensock, tftppacket, queuedtime) in list(self.pending.items()):
+            if (now - queuedtime) > PENDING_TIMEOUT:
+                logger.debug("queued request for \"%s\" from %s:%d timed out", requestkey[2], requestkey[0], requestkey[1])
+                del self.pending[requestkey]
+
+        self.metrics.pendingrequests = len(self.pending)
+
+    def startpending(self):
+        # start queued requests while there are free slots
+        now = time.monotonic()
+
+        while (len(self.pending) > 0) and (len(self.sessions) < self.maxsessions):
+            requestkey, (listensock, tftppacket, queuedtime) = self.pending.popitem(last=False)
+
+            if (now - queuedtime) > PENDING_TIMEOUT:
+                logger.debug("queued request for \"%s\" from %s:%d timed out", requestkey[2], requestkey[0], requestkey[1])
+                continue
+
+            self.startsession(listensock, requestkey[0], requestkey[1], tftppacket, True)
+
+        self.metrics.pendingrequests = len(self.pending)
+
+    def filesource(self, filename, fileentry):
+        # returns (cached, filemap) for a new transfer of the file
+        #
+        # big files are streamed from a memory mapping rather than cached so a
+        # multi-gigabyte image never pushes the small boot files out of the cache
+        cached = (self.cache is not None) and (fileentry.size <= (self.cache.maxbytes // STREAM_CACHE_FRACTION))
+
+        if fileentry.data is not None:
+            # preloaded - sent straight from memory
+            return False, fileentry.data
+
+        if self.sharedcache is not None:
+            sharedview = self.sharedcache.attach(fileentry)
+            if sharedview is not None:
+                return False, sharedview
+
+        if cached:
+            self.cache.checkversion(filename, fileentry.mtime, fileentry.size)
+            return True, None
+
+        return False, fileentry.getmap(self.batchio is not None)
+
+    def joinmulticast(self, listensock, clientip, clientport, filename, fileentry, blocksize, options):
+        # returns False when the request should be a normal transfer instead
+        if self.multicastaddresses is None:
+            return False
+
+        if hasoption(options, "blksize"):
+            blocksize = min(blocksize, self.multicastmaxblocksize)
+
+        if (fileentry.size // blocksize + 1) > MAX_MULTICAST_BLOCKS:
+            logger.info("\"%s\" is too big for a multicast transfer with block size %d - sending it to %s:%d on its own", filename, blocksize, clientip, clientport)
+            return False
+
+        setoption(options, "blksize", blocksize)
+        options = removeoption(options, "windowsize")
+
+        address = (clientip, clientport)
+        group = self.multicastgroups.get((filename, blocksize))
+
+        if (group is not None) and (group.fileentry is fileentry):
+            # the group already holds the file open
+            self.handlecache.release(fileentry)
+
+            if address not in group.members:
+                group.members[address] = options
+                logger.info("%s:%d joined the multicast transfer of \"%s\" to %s:%d   Clients: %d", clientip, clientport, filename, group.groupip, group.groupport, len(group.members))
+
+            if group.ismaster(address):
+                self.send(group, sendoptionack, group.options, group.filesize)
+            else:
+                self.sendto(group, clientip, clientport, sendoptionack, group.optionsfor(address, False), group.filesize)
+
+            return True
+
+        inuse = set(session.groupip for session in self.sessions.values() if session.multicast)
+        freeaddresses = [groupip for groupip in self.multicastaddresses if groupip not in inuse]
+
+        if len(freeaddresses) == 0:
+            logger.warning("no free multicast addresses - sending \"%s\" to %s:%d on its own", filename, clientip, clientport)
+            return False
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        try:
+            sock.bind(('', 0))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.multicastttl)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            if self.multicastinterface is not None:
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.multicastinterface))
+            sock.setblocking(False)
+        except OSError as e:
+            self.handlecache.release(fileentry)
+            sock.close()
+            self.senderror(listensock, clientip, clientport, 0, "unable to create multicast transfer socket: {}".format(e.strerror))
+            return True
+
+        cached, filemap = self.filesource(filename, fileentry)
+        timeout = getoption(options, "timeout", getoption(options, "interval", DEFAULT_TIMEOUT))
+
+        group = MulticastSession(sock, freeaddresses[0], self.multicastport, filename, fileentry, filemap, cached, blocksize, timeout)
+        group.members[address] = options
+        group.electmaster()
+
+        self.multicastgroups[(filename, blocksize)] = group
+        self.sessions[sock.fileno()] = group
+        self.watch(sock, group)
+        self.metrics.activesessions += 1
+
+        logger.info("sending \"%s\" to multicast group %s:%d   Size: %d   Block size: %d   Master: %s:%d   Port: %d   Active: %d", filename, group.groupip, group.groupport, group.filesize, blocksize, clientip, clientport, sock.getsockname()[1], len(self.sessions))
+
+        self.notify(self.sessionstarted, group)
+
+        self.transmit(group)
+
+        return True
+
+    def leavemulticast(self, group, address, completed):
+        del group.members[address]
+
+        if completed:
+            group.clientsserved += 1
+            logger.info("%s:%d has all of \"%s\" from multicast group %s:%d", address[0], address[1], group.filename, group.groupip, group.groupport)
+
+        if not group.ismaster(address):
+            return
+
+        if len(group.members) > 0:
+            group.electmaster()
+            logger.debug("%s:%d is now the master client for \"%s\"", group.clientip, group.clientport, group.filename)
+            self.transmit(group)
+            return
+
+        group.completed = group.clientsserved > 0
+
+        elapsed = max(time.monotonic() - group.starttime, 0.000001)
+        logger.info("sent \"%s\" to %d clients via multicast group %s:%d - %d bytes in %d blocks (%d retransmits, %d duplicate ACKs) in %.3f seconds",
+                    group.filename, group.clientsserved, group.groupip, group.groupport, group.bytessent, group.blockssent,
+                    group.retransmits, group.duplicateacks, elapsed)
+
+        self.endsession(group)
+
+    def endsession(self, session):
+        if session.multicast:
+            if self.multicastgroups.get((session.filename, session.blocksize)) is session:
+                del self.multicastgroups[(session.filename, session.blocksize)]
+        else:
+            requestkey = (session.clientip, session.clientport, session.filename)
+            if self.requestsessions.get(requestkey) is session:
+                del self.requestsessions[requestkey]
+
+        self.unwatch(session.sock)
+        del self.sessions[session.sock.fileno()]
+        session.close()
+        self.handlecache.release(session.fileentry)
+
+        self.metrics.activesessions -= 1
+        if session.completed:
+            self.metrics.transferscompleted += 1
+            self.metrics.transferduration.observe(time.monotonic() - session.starttime)
+        else:
+            self.metrics.transfersfailed += 1
+
+        self.notify(self.sessionended, session)
+
+    def senderror(self, sock, clientip, clientport, errorcode, errormessage):
+        self.metrics.errorssent[errorcode] += 1
+
+        try:
+            senderrormessage(sock, clientip, clientport, errorcode, errormessage)
+        except (BlockingIOError, InterruptedError, ConnectionError):
+            pass
+
+    def send(self, session, sendfunction, *args):
+        return self.sendto(session, session.clientip, session.clientport, sendfunction, *args)
+
+    def sendto(self, session, ip, port, sendfunction, *args):
+        try:
+            sendfunction(session.sock, ip, port, *args)
+        except (BlockingIOError, InterruptedError):
+            # socket buffer full - drop it, the retransmit timer will send it again
+            return False
+        except ConnectionError:
+            # an ICMP error from an earlier packet - if the client really has gone
+            # the retransmit timer gives up on it
+            return False
+
+        return True
+
+    def transmit(self, session):
+        # send whatever the client is waiting for and (re)start the retransmit timer
+        if session.oackpending:
+            self.send(session, sendoptionack, session.options, session.filesize)
+        elif self.scheduler is not None:
+            # the scheduler sends the window and starts the timer once it has gone
+            self.schedulewindow(session)
+            return
+        else:
+            self.sendwindow(session)
+
+        session.senttime = time.monotonic()
+        self.settimer(session, session.senttime + session.timeout)
+
+    def settimer(self, session, deadline):
+        # timers live in a heap - stale entries are skipped when they come due
+        session.deadline = deadline
+        self.timersequence += 1
+        heapq.heappush(self.timers, (deadline, self.timersequence, session))
+
+    def nexttimeout(self):
+        deadline = None
+
+        if len(self.timers) > 0:
+            deadline = self.timers[0][0]
+
+        if (self.scheduler is not None) and (self.scheduler.wakeup is not None):
+            if (deadline is None) or (self.scheduler.wakeup < deadline):
+                deadline = self.scheduler.wakeup
+
+        if deadline is None:
+            return SELECT_INTERVAL
+
+        return min(max(deadline - time.monotonic(), 0), SELECT_INTERVAL)
+
+    def runtimers(self):
+        now = time.monotonic()
+
+        while (len(self.timers) > 0) and (self.timers[0][0] <= now):
+            deadline, sequence, session = heapq.heappop(self.timers)
+
+            if session.closed or (deadline != session.deadline):
+                continue
+
+            if session.timedout(now) and session.multicast:
+                logger.warning("no response from master client %s:%d for %.1f seconds (%d retries) - choosing another for \"%s\"", session.clientip, session.clientport, now - session.lastheard, session.retries, session.filename)
+                self.senderror(session.sock, session.clientip, session.clientport, 0, "timed out waiting for acknowledgement")
+                self.leavemulticast(session, (session.clientip, session.clientport), False)
+                continue
+
+            if session.timedout(now):
+                logger.warning("no response from %s:%d for %.1f seconds (%d retries) - abandoning transfer of \"%s\"", session.clientip, session.clientport, now - session.lastheard, session.retries, session.filename)
+                self.senderror(session.sock, session.clientip, session.clientport, 0, "timed out waiting for acknowledgement")
+                self.endsession(session)
+                continue
+
+            session.backoff()
+            self.metrics.retransmits += 1
+            self.transmit(session)
+
+    def getdatabuffers(self, session, blocknumber):
+        offset = (blocknumber - 1) * session.blocksize
+
+        if session.cached:
+            length = max(min(session.blocksize, session.filesize - offset), 0)
+            databuffers = self.cache.read(session.fileentry, offset, length)
+        elif session.fileview is not None:
+            databuffers = [session.fileview[offset:offset + session.blocksize]]
+        else:
+            databuffers = [readblock(session.filehandle, session.fileentry.offset, session.filesize, session.blocksize, blocknumber)]
+
+        return databuffers
+
+    def sendblock(self, session, blocknumber):
+        databuffers = self.getdatabuffers(session, blocknumber)
+
+        if not self.sendto(session, session.dataip, session.dataport, senddatablock, blocknumber, databuffers):
+            return False
+
+        session.blockssent += 1
+        self.metrics.blockssent += 1
+        for databuffer in databuffers:
+            session.bytessent += len(databuffer)
+            self.metrics.bytessent += len(databuffer)
+
+        return True
+
+    def sendwindow(self, session):
+        # send the window of blocks that follows the last acknowledged block
+        lastinwindow = min(session.lastacked + session.windowsize, session.numblocks)
+
+        session.lastsent = max(session.lastsent, lastinwindow)
+
+        self.readahead(session, lastinwindow)
+
+        self.sendblocks(session, session.lastacked + 1, lastinwindow)
+
+    def schedulewindow(self, session):
+        # queue the window that follows the last acknowledged block - the
+        # retransmit timer is off until the scheduler has sent it
+        lastinwindow = min(session.lastacked + session.windowsize, session.numblocks)
+
+        session.nextblock = session.lastacked + 1
+        session.windowend = lastinwindow
+        session.lastsent = max(session.lastsent, lastinwindow)
+        session.deadline = None
+
+        self.readahead(session, lastinwindow)
+
+        self.scheduler.enqueue(session)
+
+    def runscheduler(self):
+        # one round of deficit round robin over the transfers waiting to send
+        scheduler = self.scheduler
+        now = time.monotonic()
+        wakeup = None
+
+        globalbucket = scheduler.globalbucket
+        if globalbucket is not None:
+            globalbucket.refill(now)
+
+        for ready in scheduler.ready:
+            for i in range(len(ready)):
+                session = ready.popleft()
+
+                if session.closed:
+                    continue
+
+                packetsize = session.blocksize + 4
+                allowance = min(session.deficit + SCHEDULER_QUANTUM, SCHEDULER_QUANTUM + packetsize)
+                wait = 0
+
+                if globalbucket is not None:
+                    allowance = min(allowance, globalbucket.tokens)
+                    wait = max(wait, globalbucket.wait(packetsize))
+
+                clientbucket = None
+                if not session.multicast:
+                    clientbucket = scheduler.clientbucket(session.clientip)
+                if clientbucket is not None:
+                    clientbucket.refill(now)
+                    allowance = min(allowance, clientbucket.tokens)
+                    wait = max(wait, clientbucket.wait(packetsize))
+
+                count = min(int(allowance // packetsize), session.windowend - session.nextblock + 1)
+
+                if count > 0:
+                    bytessent = session.bytessent
+                    sent = self.sendblocks(session, session.nextblock, session.nextblock + count - 1)
+                    used = (session.bytessent - bytessent) + (4 * sent)
+                    if globalbucket is not None:
+                        globalbucket.tokens -= used
+                    if clientbucket is not None:
+                        clientbucket.tokens -= used
+                    session.deficit = max(session.deficit + SCHEDULER_QUANTUM - used, 0)
+                    # anything the socket could not take is left to the retransmit timer
+                    session.nextblock += count
+                else:
+                    session.deficit = min(session.deficit + SCHEDULER_QUANTUM, SCHEDULER_QUANTUM + packetsize)
+
+                if session.nextblock > session.windowend:
+                    session.queued = False
+                    session.senttime = now
+                    self.settimer(session, now + session.timeout)
+                    continue
+
+                ready.append(session)
+
+                if count > 0:
+                    wait = 0
+                if (wakeup is None) or (now + wait < wakeup):
+                    wakeup = now + wait
+
+        scheduler.wakeup = wakeup
+
+    def sendblocks(self, session, blocknumber, lastblock):
+        # returns the number of blocks the socket took
+        if (self.batchio is not None) and (not session.multicast):
+            # the whole window goes out in one sendmmsg() call - anything the
+            # socket could not take is left to the retransmit timer (this needs
+            # a connected socket so multicast DATA goes one packet at a time)
+            blocks = []
+            while blocknumber <= lastblock:
+                blocks.append((blocknumber, self.getdatabuffers(session, blocknumber)))
+                blocknumber += 1
+            try:
+                sent = self.batchio.senddatablocks(session.sock, blocks)
+            except ConnectionError:
+                sent = 0
+            session.blockssent += sent
+            self.metrics.blockssent += sent
+            for sentblock, databuffers in blocks[0:sent]:
+                for databuffer in databuffers:
+                    session.bytessent += len(databuffer)
+                    self.metrics.bytessent += len(databuffer)
+            return sent
+
+        sent = 0
+        while blocknumber <= lastblock:
+            if not self.sendblock(session, blocknumber):
+                break
+            blocknumber += 1
+            sent += 1
+
+        return sent
+
+    def readahead(self, session, lastinwindow):
+        # keep the kernel reading the file well ahead of the blocks being sent so
+        # disk reads overlap with the network - the file offset it has been asked
+        # to read up to is moved on a window at a time once half of it is used
+        if session.readahead >= session.filesize:
+            return
+
+        if (lastinwindow * session.blocksize) + (READAHEAD_BYTES // 2) < session.readahead:
+            return
+
+        if not hasattr(os, "posix_fadvise"):
+            session.readahead = session.filesize
+            return
+
+        try:
+            os.posix_fadvise(session.filehandle.fileno(), session.fileentry.offset + session.readahead, READAHEAD_BYTES, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            session.readahead = session.filesize
+            return
+
+        session.readahead += READAHEAD_BYTES
+
+    def logsummary(self, session):
+        elapsed = max(time.monotonic() - session.starttime, 0.000001)
+
+        logger.info("sent \"%s\" to %s:%d - %d bytes in %d blocks (%d retransmits, %d duplicate ACKs) in %.3f seconds (%.1f KB/s)",
+                    session.filename, session.clientip, session.clientport, session.bytessent, session.blockssent,
+                    session.retransmits, session.duplicateacks, elapsed, session.filesize / elapsed / 1024)
+
+        if self.cache is not None:
+            logger.debug("cache: %d hits   %d misses   %d bytes used", self.cache.hits, self.cache.misses, self.cache.usedbytes)
+
+        if self.sharedcache is not None:
+            logger.debug("shared cache: %d hits   %d misses", self.sharedcache.hits, self.sharedcache.misses)
+
+    def handlesessionsocket(self, session):
+        try:
+            packets = self.receive(session.sock)
+        except ConnectionError:
+            if session.multicast:
+                # only a connected socket sees ICMP errors - this one is not
+                return
+            # ICMP port unreachable - the client has gone away
+            logger.warning("client %s:%d went away during transfer of \"%s\"", session.clientip, session.clientport, session.filename)
+            self.endsession(session)
+            return
+
+        for tftppacket, address in packets:
+            if session.closed:
+                break
+            if session.multicast:
+                self.handlemulticastpacket(session, tftppacket, address)
+            else:
+                self.handlesessionpacket(session, tftppacket)
+
+    def acknowledged(self, session):
+        # only time round trips that involved no retransmission (Karn's algorithm)
+        if not session.retransmitted:
+            sample = time.monotonic() - session.senttime
+            session.updatertt(sample)
+            self.metrics.ackrtt.observe(sample)
+        session.retries = 0
+        session.lastheard = time.monotonic()
+        session.retransmitted = False
+        session.oackpending = False
+
+    def handlesessionpacket(self, session, tftppacket):
+        if len(tftppacket) < 4:
+            logger.warning("packet length too short from %s:%d - ignoring", session.clientip, session.clientport)
+            if self.logpackets:
+                showpacket(tftppacket)
+            return
+
+        opcode, block = packetheader.unpack_from(tftppacket)
+
+        if self.logpackets:
+            logger.debug("IP: %s   Port: %d   Opcode: %d   Length: %d", session.clientip, session.clientport, opcode, len(tftppacket))
+
+        ###############################################################################
+        # opcode 4 - acknowledgement                                                  #
+        ###############################################################################
+        if opcode == 4:
+            block = session.logicalblock(block)
+
+            if session.oackpending:
+                # only ACK 0 acknowledges the OACK - nothing else has been sent yet
+                accepted = block == 0
+            else:
+                accepted = block > session.lastacked
+
+            if accepted:
+                self.acknowledged(session)
+            else:
+                # a repeated, out of date or impossible ACK - answering it would send
+                # every block after it twice for the rest of the transfer (the Sorcerer's
+                # Apprentice problem) so a lost block is left to the retransmit timer
+                session.duplicateacks += 1
+                self.metrics.duplicateacks += 1
+                return
+
+            if block == session.numblocks:
+                session.completed = True
+                self.logsummary(session)
+                self.endsession(session)
+            else:
+                # ACKs are cumulative - an ACK short of the end of the window means
+                # the client saw a gap so the window restarts after the ACKed block
+                session.lastacked = block
+                self.transmit(session)
+
+        ###############################################################################
+        # opcode 5 - error message from client                                        #
+        ###############################################################################
+        elif opcode == 5:
+            errornumber = block
+            errormessage = "error text not present in packet data"
+
+            if len(tftppacket) > 4:
+                strings = bytes(tftppacket[4:]).split(b'\x00')
+
+                if len(strings) >= 1:
+                    errormessage = strings[0].decode("utf-8", errors="replace")
+
+            self.metrics.errorsreceived[errornumber] += 1
+            logger.warning("error code %d from %s:%d during transfer of \"%s\" - message reads: %s", errornumber, session.clientip, session.clientport, session.filename, errormessage)
+            self.endsession(session)
+
+        ###############################################################################
+        # opcode unknown or not valid during a read transfer                          #
+        ###############################################################################
+        else:
+            self.senderror(session.sock, session.clientip, session.clientport, 4, "unexpected packet with opcode {} during read transfer".format(opcode))
+            self.endsession(session)
+
+    def handlemulticastpacket(self, group, tftppacket, address):
+        clientip = address[0]
+        clientport = address[1]
+
+        if len(tftppacket) < 4:
+            logger.warning("packet length too short from %s:%d - ignoring", clientip, clientport)
+            if self.logpackets:
+                showpacket(tftppacket)
+            return
+
+        opcode, block = packetheader.unpack_from(tftppacket)
+
+        if self.logpackets:
+            logger.debug("IP: %s   Port: %d   Opcode: %d   Length: %d", clientip, clientport, opcode, len(tftppacket))
+
+        if address not in group.members:
+            self.senderror(group.sock, clientip, clientport, 5, "unknown transfer ID")
+            return
+
+        ###############################################################################
+        # opcode 4 - acknowledgement                                                  #
+        ###############################################################################
+        if opcode == 4:
+            if not group.ismaster(address):
+                # only the master client ACKs DATA - any other client ACKing
+                # the last block is saying it has the whole file
+                if block == group.numblocks:
+                    self.leavemulticast(group, address, True)
+                return
+
+            if group.oackpending and (block <= group.numblocks):
+                # a new master starts from the first block it is missing
+                self.acknowledged(group)
+                group.lastacked = block
+            elif (not group.oackpending) and (group.lastacked < block <= group.lastsent):
+                self.acknowledged(group)
+            else:
+                # an old, duplicate or impossible ACK - answering it would double
+                # every DATA packet from then on (the Sorcerer's Apprentice problem)
+                # so a lost block is left to the retransmit timer
+                group.duplicateacks += 1
+                self.metrics.duplicateacks += 1
+                return
+
+            if block == group.numblocks:
+                self.leavemulticast(group, address, True)
+            else:
+                group.lastacked = block
+                self.transmit(group)
+
+        ###############################################################################
+        # opcode 5 - error message from client                                        #
+        ###############################################################################
+        elif opcode == 5:
+            errornumber = block
+
+            self.metrics.errorsreceived[errornumber] += 1
+            logger.info("%s:%d left the multicast transfer of \"%s\" with error code %d", clientip, clientport, group.filename, errornumber)
+            self.leavemulticast(group, address, False)
+
+        ###############################################################################
+        # opcode unknown or not valid during a read transfer                          #
+        ###############################################################################
+        else:
+            self.senderror(group.sock, clientip, clientport, 4, "unexpected packet with opcode {} during read transfer".format(opcode))
+            self.leavemulticast(group, address, False)
+
+##############################################################################
+
+#
+# an AsyncTransferEngine is driven by an asyncio event loop instead of its
+# own selector loop - sockets are watched with add_reader() and the timers,
+# scheduler and the rest of the housekeeping run from a call_later() that
+# is set for the next thing due after every event
+#
+
+class AsyncTransferEngine(TransferEngine):
+    def __init__(self, loop, *args):
+        self.loop = loop
+        self.tickhandle = None
+        self.finished = loop.create_future()
+        TransferEngine.__init__(self, *args)
+
+    def watch(self, fileobj, data):
+        self.loop.add_reader(fileobj, self.ready, fileobj, data)
+
+    def unwatch(self, fileobj):
+        self.loop.remove_reader(fileobj)
+
+    def ready(self, fileobj, data):
+        self.dispatch(fileobj, data)
+        self.tick()
+
+    def tick(self):
+        if self.finished.done():
+            return
+
+        if self.tickhandle is not None:
+            self.tickhandle.cancel()
+            self.tickhandle = None
+
+        self.housekeeping()
+
+        if self.checkstopping():
+            self.close()
+            self.finished.set_result(None)
+            return
+
+        self.tickhandle = self.loop.call_later(self.nexttimeout(), self.tick)
+
+    def shutdown(self):
+        TransferEngine.shutdown(self)
+        self.loop.call_soon(self.tick)
+
+##############################################################################
+
+#
+# a TFTPServer serves files from inside a program that already runs an
+# asyncio event loop - for example:
+#
+#     server = rotftp.TFTPServer(root="/srv/tftp", port=0)
+#     await server.start()
+#     ... server.port is the port the kernel picked ...
+#     await server.close()
+#
+# or await server.serve_forever() until another task closes it
+#
+# sessionstarted and sessionended are called with the Session when each
+# transfer starts and ends (session.completed says whether the client got
+# the whole file) - the server does not set up logging or signal handlers
+#
+
+class TFTPServer:
+    def __init__(self, root=".", host="", port=DEFAULT_PORT, archive=None, cachemb=DEFAULT_CACHE_MB,
+                 spooldirectory=DEFAULT_SPOOL_DIRECTORY, maxblksize=0, maxwindowsize=MAX_WINDOWSIZE,
+                 maxsessions=0, maxpending=DEFAULT_MAX_PENDING, maxrate=0, perclientrate=0, prioritysize=0,
+                 sharedcachemb=0, sharedcachedirectory=DEFAULT_SHARED_CACHE_DIRECTORY,
+                 sessionstarted=None, sessionended=None):
+        if (maxblksize != 0) and (maxblksize < DEFAULT_BLOCKSIZE):
+            raise ValueError("maxblksize must be at least {}".format(DEFAULT_BLOCKSIZE))
+
+        self.root = root
+        self.host = host
+        self.requestedport = port
+        self.archive = archive
+        self.cachemb = cachemb
+        self.spooldirectory = spooldirectory
+        self.maxblksize = maxblksize
+        self.maxwindowsize = maxwindowsize
+        self.maxsessions = maxsessions
+        self.maxpending = maxpending
+        self.maxrate = maxrate
+        self.perclientrate = perclientrate
+        self.prioritysize = prioritysize
+        self.sharedcachemb = sharedcachemb
+        self.sharedcachedirectory = sharedcachedirectory
+        self.sessionstarted = sessionstarted
+        self.sessionended = sessionended
+        self.metrics = Metrics()
+        self.engine = None
+        self.sock = None
+
+    @property
+    def port(self):
+        # the port actually bound - useful after asking for port 0
+        return self.sock.getsockname()[1]
+
+    async def start(self):
+        # raises OSError if the port cannot be bound or the archive, spool
+        # directory or shared cache directory cannot be used
+        loop = asyncio.get_running_loop()
+
+        if self.archive is not None:
+            backend = ArchiveBackend(self.archive)
+        else:
+            backend = FileSystemBackend(self.spooldirectory, self.root)
+
+        if self.cachemb > 0:
+            cache = BlockCache(self.cachemb * 1024 * 1024)
+        else:
+            cache = None
+
+        if (self.maxrate > 0) or (self.perclientrate > 0):
+            scheduler = FairScheduler(self.maxrate * 1024, self.perclientrate * 1024, self.prioritysize * 1024)
+        else:
+            scheduler = None
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind((self.host, self.requestedport))
+        except OSError:
+            sock.close()
+            raise
+
+        self.sock = sock
+        self.engine = AsyncTransferEngine(loop, cache, None, self.metrics, self.maxblksize, backend, scheduler)
+        self.engine.maxwindowsize = self.maxwindowsize
+        self.engine.sessionstarted = self.sessionstarted
+        self.engine.sessionended = self.sessionended
+        if self.maxsessions > 0:
+            self.engine.limitsessions(self.maxsessions, self.maxpending)
+        if self.sharedcachemb > 0:
+            try:
+                self.engine.enablesharedcache(self.sharedcachedirectory, self.sharedcachemb * 1024 * 1024)
+            except OSError:
+                self.engine.close()
+                self.engine = None
+                sock.close()
+                raise
+        self.engine.addlistensocket(sock)
+        self.engine.tick()
+
+    async def serve_forever(self):
+        if self.engine is None:
+            await self.start()
+
+        await asyncio.shield(self.engine.finished)
+
+    async def close(self, abandon=False):
+        # stop taking requests and wait for active transfers to finish - or
+        # with abandon end them straight away
+        if self.engine is None:
+            return
+
+        self.engine.shutdown()
+        if abandon:
+            self.engine.shutdown()
+
+        await asyncio.shield(self.engine.finished)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exctype, exc, traceback):
+        await self.close(abandon=True)
+
+##############################################################################
+
+#
+# run one server process - a worker when reuseport is True
+#
+
+def runserver(args, workernumber):
+    reuseport = workernumber > 0
+
+    # create a UDP socket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    # let several worker processes bind the same port - the kernel shares requests out between them
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    # bind the socket to the port
+    try:
+        sock.bind(('', args.port))
+    except OSError as e:
+        logger.error("unable to bind to port %d: %s", args.port, e.strerror)
+        return 2
+
+    if args.cache_mb > 0:
+        cache = BlockCache(args.cache_mb * 1024 * 1024)
+    else:
+        cache = None
+
+    if args.batch > 1:
+        batchio = MultiMessageIO(args.batch)
+    else:
+        batchio = None
+
+    metrics = Metrics()
+
+    # each worker has its own metrics - worker N listens on the metrics port plus N - 1
+    if args.metrics_port > 0:
+        metricsport = args.metrics_port + max(workernumber - 1, 0)
+        try:
+            startmetricslistener(metrics, metricsport)
+        except OSError as e:
+            logger.error("unable to listen for metrics requests on port %d: %s", metricsport, e.strerror)
+            return 2
+        logger.info("metrics available at http://127.0.0.1:%d/metrics", metricsport)
+
+    if args.metrics_file is not None:
+        if workernumber > 0:
+            startmetricswriter(metrics, "{}.{}".format(args.metrics_file, workernumber))
+        else:
+            startmetricswriter(metrics, args.metrics_file)
+
+    if (args.max_rate > 0) or (args.per_client_rate > 0):
+        scheduler = FairScheduler(args.max_rate * 1024, args.per_client_rate * 1024, args.priority_size * 1024)
+    else:
+        scheduler = None
+
+    if args.archive is not None:
+        try:
+            backend = ArchiveBackend(args.archive)
+        except OSError as e:
+            logger.error("unable to serve archive \"%s\": %s", args.archive, e.strerror)
+            return 2
+    else:
+        try:
+            backend = FileSystemBackend(args.spool_dir, ".")
+        except OSError as e:
+            logger.error("unable to use spool directory \"%s\": %s", args.spool_dir, e.strerror)
+            return 2
+
+    engine = TransferEngine(cache, batchio, metrics, args.max_blksize, backend, scheduler)
+    engine.addlistensocket(sock)
+
+    profiler = None
+    if args.profile is not None:
+        if workernumber > 0:
+            profiler = Profiler("{}.{}".format(args.profile, workernumber), args.profile_python)
+        else:
+            profiler = Profiler(args.profile, args.profile_python)
+        profiler.instrument(engine)
+
+    if args.max_sessions > 0:
+        engine.limitsessions(args.max_sessions, args.max_pending)
+
+    if args.shared_cache_mb > 0:
+        try:
+            engine.enablesharedcache(args.shared_cache_dir, args.shared_cache_mb * 1024 * 1024)
+        except OSError as e:
+            logger.error("unable to use shared cache directory \"%s\": %s", args.shared_cache_dir, e.strerror)
+            return 2
+
+    if args.multicast_address is not None:
+        engine.enablemulticast(args.multicast_address, args.multicast_port, args.multicast_ttl, args.multicast_interface, max(workernumber - 1, 0), args.workers)
+
+    for pattern in args.preload:
+        paths = backend.match(pattern)
+        if len(paths) == 0:
+            logger.warning("no files match --preload \"%s\"", pattern)
+        for path in paths:
+            try:
+                size = engine.handlecache.preload(path)
+            except OSError as e:
+                logger.warning("unable to preload \"%s\": %s", path, e.strerror)
+                continue
+            if workernumber <= 1:
+                logger.info("preloaded \"%s\" (%d bytes)", path, size)
+
+    def handleshutdownsignal(signum, frame):
+        engine.shutdown()
+
+    signal.signal(signal.SIGTERM, handleshutdownsignal)
+
+    if reuseport:
+        # the parent passes Ctrl+C on to workers as SIGTERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    else:
+        signal.signal(signal.SIGINT, handleshutdownsignal)
+
+    if (profiler is not None) and hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.dump())
+
+    logger.info("waiting for TFTP requests")
+
+    if profiler is not None:
+        profiler.start()
+        try:
+            engine.run()
+        finally:
+            profiler.dump()
+    else:
+        engine.run()
+
+    return 0
+
+##############################################################################
+
+#
+# fork the worker processes, restart any that die and pass shutdown
+# signals on to them
+#
+
+def superviseworkers(args):
+    workers = {}
+    stopping = False
+
+    def startworker(workernumber):
+        pid = os.fork()
+
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # the parent's log writing thread does not exist in the child
+            listener = setuplogging(args.log_level)
+            exitcode = 1
+            try:
+                exitcode = runserver(args, workernumber)
+            finally:
+                listener.stop()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exitcode)
+
+        workers[pid] = workernumber
+        logger.info("started worker %d with process ID %d", workernumber, pid)
+
+    def handleshutdownsignal(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def handleprofilesignal(signum, frame):
+        for pid in workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, handleshutdownsignal)
+    signal.signal(signal.SIGTERM, handleshutdownsignal)
+
+    if args.profile is not None:
+        signal.signal(signal.SIGUSR1, handleprofilesignal)
+
+    for workernumber in range(1, args.workers + 1):
+        startworker(workernumber)
+
+    exitcode = 0
+
+    while len(workers) > 0:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+
+        workernumber = workers.pop(pid, None)
+
+        if workernumber is None or stopping:
+            continue
+
+        if os.WIFEXITED(status) and (os.WEXITSTATUS(status) == 2):
+            # the worker could not start (e.g. the port is in use) so restarting will not help
+            logger.error("worker %d failed to start - shutting down", workernumber)
+            exitcode = 2
+            handleshutdownsignal(signal.SIGTERM, None)
+            continue
+
+        logger.error("worker %d (process ID %d) died with status %d - restarting", workernumber, pid, status)
+        time.sleep(WORKER_RESTART_DELAY)
+
+        if not stopping:
+            startworker(workernumber)
+
+    return exitcode
+
+##############################################################################
+
+#
+# Main code
+#
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--dir",  help="initial directory to change to", default=DEFAULT_DIRECTORY)
+    parser.add_argument("--archive", help="serve the files in this tar or zip archive instead of --dir", default=None)
+    parser.add_argument("--cache-mb", help="megabytes of memory for caching file contents (0 to disable)", type=int, default=DEFAULT_CACHE_MB)
+    parser.add_argument("--port", help="UDP port to listen for requests on", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--max-blksize", help="largest block size to agree to (default: fit the path MTU where it can be found)", type=int, default=0)
+    parser.add_argument("--workers", help="number of worker processes sharing the port (needs fork and SO_REUSEPORT)", type=int, default=1)
+    parser.add_argument("--log-level", help="least important messages to log", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO")
+    parser.add_argument("--metrics-port", help="serve Prometheus metrics on this local HTTP port (0 to disable)", type=int, default=0)
+    parser.add_argument("--metrics-file", help="rewrite this file with Prometheus metrics every {} seconds".format(METRICS_FILE_INTERVAL), default=None)
+    parser.add_argument("--max-sessions", help="most transfers to run at once (0 for no limit)", type=int, default=0)
+    parser.add_argument("--max-pending", help="requests to queue when --max-sessions transfers are running", type=int, default=DEFAULT_MAX_PENDING)
+    parser.add_argument("--max-rate", help="total KB per second sent to all clients (0 for no limit)", type=int, default=0)
+    parser.add_argument("--per-client-rate", help="KB per second sent to any one client IP address (0 for no limit)", type=int, default=0)
+    parser.add_argument("--priority-size", help="files up to this many KB are sent ahead of bigger ones when rates are limited", type=int, default=0)
+    parser.add_argument("--multicast-address", help="first multicast group address for RFC 2090 transfers (default: multicast disabled)", default=None)
+    parser.add_argument("--multicast-port", help="UDP port multicast DATA is sent to", type=int, default=DEFAULT_MULTICAST_PORT)
+    parser.add_argument("--multicast-ttl", help="time to live of multicast DATA packets", type=int, default=1)
+    parser.add_argument("--multicast-interface", help="IP address of the interface to send multicast DATA from", default=None)
+    parser.add_argument("--spool-dir", help="directory to decompress .gz, .xz and .zst files into", default=DEFAULT_SPOOL_DIRECTORY)
+    parser.add_argument("--shared-cache-mb", help="megabytes of files to share between server processes through --shared-cache-dir (0 to disable)", type=int, default=0)
+    parser.add_argument("--shared-cache-dir", help="directory on a memory file system for the shared cache", default=DEFAULT_SHARED_CACHE_DIRECTORY)
+    parser.add_argument("--preload", help="hold files matching this pattern in memory from startup (can be repeated)", action="append", default=[])
+    parser.add_argument("--batch", help="datagrams per recvmmsg()/sendmmsg() call on Linux (0 or 1 for one system call per packet)", type=int, default=0)
+    parser.add_argument("--profile", help="time each stage of the packet loop and write the results to this file on exit and on SIGUSR1", default=None)
+    parser.add_argument("--profile-python", help="add cProfile statistics for every Python function to the --profile file (slow)", action="store_true")
+
+    args = parser.parse_args()
+
+    listener = setuplogging(args.log_level)
+
+    try:
+        return runmain(args)
+    finally:
+        listener.stop()
+
+def runmain(args):
+    initdir = args.dir
+
+    # relative to where the server was started, not to --dir
+    args.spool_dir = os.path.abspath(args.spool_dir)
+    args.shared_cache_dir = os.path.abspath(args.shared_cache_dir)
+    if args.profile is not None:
+        args.profile = os.path.abspath(args.profile)
+    elif args.profile_python:
+        logger.error("--profile-python needs --profile")
+        sys.exit(2)
+
+    if args.archive is not None:
+        args.archive = os.path.abspath(args.archive)
+    else:
+        try:
+            os.chdir(initdir)
+        except OSError:
+            logger.error("unable to change to initial directory \"%s\"", initdir)
+            sys.exit(2)
+
+    if args.workers < 1:
+        logger.error("number of workers must be at least 1")
+        sys.exit(2)
+
+    if (args.max_blksize != 0) and (args.max_blksize < DEFAULT_BLOCKSIZE):
+        # clients that do not negotiate blksize get 512 byte blocks regardless
+        logger.error("--max-blksize must be at least %d", DEFAULT_BLOCKSIZE)
+        sys.exit(2)
+
+    if args.multicast_address is not None:
+        try:
+            if not ipaddress.IPv4Address(args.multicast_address).is_multicast:
+                logger.error("\"%s\" is not a multicast address", args.multicast_address)
+                sys.exit(2)
+        except ipaddress.AddressValueError:
+            logger.error("\"%s\" is not an IPv4 address", args.multicast_address)
+            sys.exit(2)
+
+    if (args.batch > 1) and (not MultiMessageIO.available()):
+        logger.warning("recvmmsg()/sendmmsg() not available - sending and receiving one packet per system call")
+        args.batch = 0
+
+    if args.workers == 1:
+        return runserver(args, 0)
+
+    if (not hasattr(os, "fork")) or (not hasattr(socket, "SO_REUSEPORT")):
+        logger.error("--workers needs fork() and SO_REUSEPORT which this platform does not have")
+        sys.exit(2)
+
+    return superviseworkers(args)
 
-        ###############################################################################
-        # opcode unknown                                                              #
-        ###############################################################################
-        else:
-            senderrormessage(sock, clientip, clientport, 0, "unexpected packet with opcode {} during idle state".format(opcode))
-        
 ##########################################################################
 
-progname = os.path.basename(sys.argv[0])
+if __name__ == "__main__":
+    progname = os.path.basename(sys.argv[0])
 
-sys.exit(main())
+    sys.exit(main())
 
 # end of file